@@ -0,0 +1,202 @@
+# Imports
+from __future__ import annotations
+import os
+import copy
+import json
+import random
+from typing import Optional
+
+import requests
+
+from nextbike.utils import country_code_map
+
+
+fixture_folder = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# countries, organizations per country, cities per organization, stations per city, mean bikes per station
+scales = {
+    "city": (1, 1, 1, 400, 3),
+    "country": (1, 40, 2, 150, 3),
+    "world": (25, 10, 2, 100, 2),
+}
+# Scales built by replicating the organizations of another scale
+replicated = {
+    "world10": ("world", 10),
+}
+
+_states = ["ok", "ok", "ok", "ok", "defect", "maintenance"]
+
+
+def fixture_path(scale: str) -> str:
+    return os.path.join(fixture_folder, f"nextbike-live_{scale}.json")
+
+
+def load_fixture(scale: str, regenerate: bool = False) -> bytes:
+    '''Raw nextbike-live.json of a scale, generated once and cached in benchmarks/fixtures.'''
+    path = fixture_path(scale)
+    if regenerate or not os.path.exists(path):
+        if scale == "recorded":
+            raise FileNotFoundError(f"No recorded feed at {path}. Record one with --record first.")
+        if scale in replicated:
+            base, factor = replicated[scale]
+            data = replicate(json.loads(load_fixture(base)), factor)
+        elif scale in scales:
+            data = generate(*scales[scale])
+        else:
+            raise ValueError(f"Unknown scale '{scale}'. Choose from {list(scales) + list(replicated) + ['recorded']}.")
+        save_fixture(data, path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def save_fixture(data: dict, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+
+
+def record(url: str = "https://api.nextbike.net/maps/nextbike-live.json", factor: Optional[int] = None):
+    '''Record the live feed as the "recorded" fixture, optionally replicated factor times as "recorded<factor>".'''
+    res = requests.get(url, timeout=60)
+    res.raise_for_status()
+    data = res.json()
+    save_fixture(data, fixture_path("recorded"))
+    if factor:
+        save_fixture(replicate(data, factor), fixture_path(f"recorded{factor}"))
+
+
+def generate(countries: int, organizations: int, cities: int, stations: int, bikes: float, seed: int = 0) -> dict:
+    '''Deterministic synthetic feed with the structure and field set of nextbike-live.json.'''
+    rng = random.Random(seed)
+    codes = sorted(country_code_map)
+    if countries > len(codes):
+        raise ValueError(f"At most {len(codes)} countries are supported.")
+    next_id = iter(range(1, 1 << 62))
+    result = []
+    for code in codes[:countries]:
+        country_lat, country_lng = country_code_map[code]
+        for o in range(organizations):
+            org_lat, org_lng = country_lat + rng.uniform(-2, 2), country_lng + rng.uniform(-2, 2)
+            domain = f"{code}{o}"
+            city_list = []
+            for c in range(cities):
+                city_lat, city_lng = org_lat + rng.uniform(-0.5, 0.5), org_lng + rng.uniform(-0.5, 0.5)
+                places = []
+                for s in range(stations):
+                    n_bikes = min(int(rng.expovariate(1 / bikes)), 30) if bikes else 0
+                    bike_list = [{
+                        "number": str(next(next_id)),
+                        "bike_type": rng.choice((15, 71, 196)),
+                        "lock_types": ["frame_lock"],
+                        "active": rng.random() > 0.05,
+                        "state": rng.choice(_states),
+                        "electric_lock": True,
+                        "boardcomputer": next(next_id),
+                        "pedelec_battery": None,
+                        "battery_pack": None,
+                    } for _ in range(n_bikes)]
+                    single = rng.random() < 0.1
+                    places.append({
+                        "uid": next(next_id),
+                        "lat": round(city_lat + rng.uniform(-0.05, 0.05), 6),
+                        "lng": round(city_lng + rng.uniform(-0.05, 0.05), 6),
+                        "bike": single,
+                        "name": f"BIKE {bike_list[0]['number']}" if single and bike_list else f"Station {c}-{s}",
+                        "address": None,
+                        "spot": not single,
+                        "number": rng.randrange(1000, 9999),
+                        "booked_bikes": 0,
+                        "bikes": n_bikes,
+                        "bikes_available_to_rent": sum(b["active"] and b["state"] == "ok" for b in bike_list),
+                        "active_place": 1,
+                        "bike_racks": n_bikes + 4,
+                        "free_racks": 4,
+                        "special_racks": 0,
+                        "free_special_racks": 0,
+                        "maintenance": False,
+                        "terminal_type": "sign",
+                        "bike_list": bike_list,
+                        "bike_numbers": [b["number"] for b in bike_list],
+                        "bike_types": {},
+                        "place_type": "0",
+                        "rack_locks": False,
+                    })
+                city_list.append({
+                    "uid": next(next_id),
+                    "lat": round(city_lat, 6),
+                    "lng": round(city_lng, 6),
+                    "zoom": 13,
+                    "maps_icon": "",
+                    "alias": f"city{c}",
+                    "break": False,
+                    "name": f"City {code.upper()} {o}-{c}",
+                    "num_places": len(places),
+                    "refresh_rate": "10000",
+                    "bounds": {},
+                    "booked_bikes": 0,
+                    "set_point_bikes": 0,
+                    "available_bikes": sum(p["bikes_available_to_rent"] for p in places),
+                    "return_to_official_only": False,
+                    "bike_types": {},
+                    "website": "",
+                    "places": places,
+                })
+            result.append({
+                "lat": round(org_lat, 6),
+                "lng": round(org_lng, 6),
+                "zoom": 9,
+                "name": f"nextbike {code.upper()} {o}",
+                "hotline": "",
+                "domain": domain,
+                "language": "en",
+                "email": "",
+                "timezone": "Europe/Berlin",
+                "currency": "EUR",
+                "country_calling_code": "",
+                "system_operator_address": "",
+                "country": code.upper(),
+                "country_name": code.upper(),
+                "terms": "",
+                "policy": "",
+                "website": "",
+                "show_bike_types": False,
+                "show_bike_type_groups": False,
+                "show_free_racks": True,
+                "booked_bikes": 0,
+                "set_point_bikes": 0,
+                "available_bikes": sum(c["available_bikes"] for c in city_list),
+                "capped_available_bikes": False,
+                "no_registration": False,
+                "pricing": "",
+                "vat": "19",
+                "faq_url": "",
+                "store_uri_android": "",
+                "store_uri_ios": "",
+                "cities": city_list,
+            })
+    return {"countries": result}
+
+
+def replicate(data: dict, factor: int) -> dict:
+    '''Copy all organizations factor times with fresh domains and ids to scale up a feed.'''
+    ids = [0]
+
+    def fresh_id() -> int:
+        ids[0] += 1
+        return ids[0]
+
+    result = []
+    for k in range(factor):
+        for organization in data["countries"]:
+            organization = copy.deepcopy(organization)
+            organization["name"] = f"{organization['name']} #{k}"
+            organization["domain"] = f"{organization.get('domain', '')}{k}"
+            for city in organization["cities"]:
+                city["uid"] = fresh_id()
+                for place in city["places"]:
+                    place["uid"] = fresh_id()
+                    for bike in place["bike_list"]:
+                        bike["number"] = str(fresh_id())
+                    place["bike_numbers"] = [bike["number"] for bike in place["bike_list"]]
+            result.append(organization)
+    return {"countries": result}
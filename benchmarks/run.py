@@ -0,0 +1,265 @@
+'''Benchmarks of the fetch, parse, log, load and visualization hot paths.
+
+Usage, from the repository root:
+    python -m benchmarks.run --scales city country --repeat 5
+    python -m benchmarks.run --scales world --stages process stations bikes --baseline <commit>
+    python -m benchmarks.run --record 10  # record the live feed as the "recorded" and "recorded10" scales
+
+Every stage is timed repeat times, then run once more under tracemalloc for the peak and retained
+memory. Results are appended to benchmarks/results.jsonl together with the git commit, and compared
+against the latest results of another commit, so regressions show up before deploying.'''
+# Imports
+from __future__ import annotations
+import gc
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Optional
+
+from nextbike import Client, viz
+
+from .fixtures import load_fixture, record
+from .server import FakeServer
+
+
+results_path = os.path.join(os.path.dirname(__file__), "results.jsonl")
+_max_marker_stations = 2000  # One icon marker per station gets too slow above
+
+
+class Context:
+    '''Shared state of the stages of one scale.'''
+
+    def __init__(self, scale: str, body: bytes, url: str, folder: str):
+        self.scale = scale
+        self.body = body
+        self.url = url
+        self.folder = folder
+        self.data = json.loads(body)
+        self.client = Client(logfolder=os.path.join(folder, "logfiles"), _url=url)
+        self.client.data = self.data
+        self.client._process_raw_data()
+        self.conditional = Client(_url=url)
+        self.conditional.fetch()
+
+    @property
+    def largest_country(self):
+        return max(self.client.countries.values(), key=lambda country: len(country.stations))
+
+    def city_files(self) -> list[str]:
+        folder = os.path.join(self.client.logfolder, "cities")
+        if not os.path.isdir(folder):
+            stage_log(self)
+        return [os.path.join(folder, id, name) for id in os.listdir(folder)
+                for name in os.listdir(os.path.join(folder, id))]
+
+
+# ------------------------ stages ----------------------------------------------
+def stage_fetch(ctx: Context):
+    Client(_url=ctx.url).fetch()
+
+
+def stage_fetch_stream(ctx: Context):
+    Client(_url=ctx.url).fetch(stream=True)
+
+
+def stage_fetch_columnar(ctx: Context):
+    Client(columnar=True, _url=ctx.url).fetch()
+
+
+def stage_fetch_conditional(ctx: Context):
+    ctx.conditional.fetch()
+
+
+def stage_parse(ctx: Context):
+    json.loads(ctx.body)
+
+
+def stage_process(ctx: Context):
+    ctx.client._process_raw_data()
+
+
+def stage_process_columnar(ctx: Context):
+    client = Client(columnar=True)
+    client.data = ctx.data
+    client._process_raw_data()
+
+
+def stage_stations(ctx: Context):
+    for country in ctx.client.countries.values():
+        country._invalidate()
+        country.stations
+
+
+def stage_bikes(ctx: Context):
+    for country in ctx.client.countries.values():
+        country._invalidate()
+        country.bikes
+
+
+def stage_log(ctx: Context):
+    shutil.rmtree(ctx.client.logfolder, ignore_errors=True)
+    for city_id in ctx.client.cities:
+        ctx.client.log_city(city_id)
+
+
+def stage_load(ctx: Context):
+    for path in ctx.city_files():
+        ctx.client.load_city(path)
+
+
+def stage_load_many(ctx: Context):
+    ctx.client.load_many(ctx.city_files(), "city")
+
+
+def stage_bikemap_markers(ctx: Context):
+    viz.bikemap(ctx.largest_country, ctx.folder, "markers.html")
+
+
+def stage_bikemap_cluster(ctx: Context):
+    viz.bikemap(ctx.largest_country, ctx.folder, "cluster.html", mode="cluster")
+
+
+def stage_bikemap_geojson(ctx: Context):
+    viz.bikemap(ctx.largest_country, ctx.folder, "geojson.html", mode="geojson")
+
+
+stages: dict[str, Callable[[Context], None]] = {
+    name[len("stage_"):]: f for name, f in list(globals().items()) if name.startswith("stage_")
+}
+# Stages only run for some scales
+applicable: dict[str, Callable[[Context], bool]] = {
+    "bikemap_markers": lambda ctx: len(ctx.largest_country.stations) <= _max_marker_stations,
+}
+
+
+# ------------------------ measuring -------------------------------------------
+def measure(f: Callable[[], None], repeat: int) -> dict:
+    '''Wall times of repeat runs, then peak and retained memory of one run under tracemalloc.'''
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    f()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    return {
+        "wall_min": min(times),
+        "wall_median": statistics.median(times),
+        "peak_bytes": peak,
+        "retained_bytes": retained,
+        "retained_blocks": sys.getallocatedblocks() - blocks,
+    }
+
+
+def git_commit() -> tuple[Optional[str], bool]:
+    '''Current commit and whether the package has uncommitted changes.'''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "nextbike"], cwd=root, capture_output=True,
+                               text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, dirty
+
+
+def run(scales: list[str], stage_names: list[str], repeat: int, regenerate: bool = False) -> list[dict]:
+    commit, dirty = git_commit()
+    meta = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+    }
+    results = []
+    for scale in scales:
+        body = load_fixture(scale, regenerate)
+        with FakeServer(body) as server, tempfile.TemporaryDirectory() as folder:
+            ctx = Context(scale, body, server.url, folder)
+            print(f"{scale}: {len(body) / 1e6:.1f} MB, {len(ctx.client.stations)} stations, "
+                  f"{len(ctx.client.bikes)} bikes")
+            for name in stage_names:
+                if name in applicable and not applicable[name](ctx):
+                    continue
+                result = dict(meta, scale=scale, stage=name, **measure(lambda: stages[name](ctx), repeat))
+                results.append(result)
+                print(f"\t{name:<18} {result['wall_min'] * 1e3:10.1f} ms {result['peak_bytes'] / 1e6:10.1f} MB peak")
+    return results
+
+
+def save(results: list[dict], path: str = results_path):
+    with open(path, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+
+def compare(results: list[dict], path: str = results_path, baseline: Optional[str] = None,
+            threshold: float = 0.1) -> list[str]:
+    '''Compare results against the latest recorded results of the baseline commit, or of the last other
+    commit. Returns the regressions by more than threshold in wall time or peak memory.'''
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        history = [json.loads(line) for line in f if line.strip()]
+    regressions = []
+    for result in results:
+        previous = [h for h in history
+                    if h["scale"] == result["scale"] and h["stage"] == result["stage"]
+                    and (h["commit"] == baseline if baseline else h["commit"] != result["commit"])]
+        if not previous:
+            continue
+        before = previous[-1]
+        for metric in ("wall_min", "peak_bytes"):
+            ratio = result[metric] / before[metric] if before[metric] else 1
+            line = f"{result['scale']}/{result['stage']} {metric}: {ratio:.2f}x vs {before['commit']}"
+            print(("REGRESSION " if ratio > 1 + threshold else "           ") + line)
+            if ratio > 1 + threshold:
+                regressions.append(line)
+    return regressions
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the nextbike hot paths against local fixtures.")
+    parser.add_argument("--scales", nargs="+", default=["city", "country"],
+                        help="city, country, world, world10 or recorded")
+    parser.add_argument("--stages", nargs="+", default=list(stages), choices=list(stages))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--results", default=results_path)
+    parser.add_argument("--no-save", action="store_true", help="do not append the results")
+    parser.add_argument("--baseline", help="commit to compare against, default the last other commit")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown counted as regression")
+    parser.add_argument("--regenerate", action="store_true", help="regenerate the synthetic fixtures")
+    parser.add_argument("--record", type=int, nargs="?", const=0, metavar="FACTOR",
+                        help="record the live feed, optionally also replicated FACTOR times, and exit")
+    args = parser.parse_args(argv)
+
+    if args.record is not None:
+        record(factor=args.record)
+        return 0
+    results = run(args.scales, args.stages, args.repeat, args.regenerate)
+    regressions = compare(results, args.results, args.baseline, args.threshold)
+    if not args.no_save:
+        save(results, args.results)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+# Imports
+from __future__ import annotations
+import gzip
+import json
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from nextbike.replay import filter_feed
+
+
+class FakeServer:
+    '''Local stand-in for the nextbike api serving a fixture.
+
+    Supports the domains and city query parameters, gzip content encoding and ETag based
+    conditional requests like the live api. Use as a context manager, the url points at
+    /maps/nextbike-live.json.'''
+
+    def __init__(self, body: bytes, host: str = "127.0.0.1", port: int = 0):
+        self.body = body
+        self._organizations = None
+        self._responses: dict[str, tuple[bytes, bytes, str]] = dict()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/maps/nextbike-live.json"
+
+    def __enter__(self) -> FakeServer:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def update(self, body: bytes):
+        '''Serve another feed from now on, e.g. one with an added organization.'''
+        with self._lock:
+            self.body = body
+            self._organizations = None
+            self._responses = dict()
+
+    def response(self, query: str) -> tuple[bytes, bytes, str]:
+        '''(body, gzipped body, etag) for a query string, computed once per query.'''
+        with self._lock:
+            cached = self._responses.get(query)
+            if cached is None:
+                body = self.body if not query else self._filter(query)
+                cached = (body, gzip.compress(body, compresslevel=6), f'"{hashlib.sha1(body).hexdigest()}"')
+                self._responses[query] = cached
+            return cached
+
+    def _filter(self, query: str) -> bytes:
+        if self._organizations is None:
+            self._organizations = json.loads(self.body)["countries"]
+        return filter_feed(self._organizations, query)
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                url = urlparse(self.path)
+                if url.path != "/maps/nextbike-live.json":
+                    self.send_error(404)
+                    return
+                body, compressed, etag = server.response(url.query)
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = compressed
+                    self.send_response(200)
+                    self.send_header("Content-Encoding", "gzip")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
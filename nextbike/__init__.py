@@ -1,3 +1,17 @@
 from .nextbike import *
 from .utils import *
 from .viz import *
+from .columnar import *
+from .diff import *
+from .history import *
+from .bulk import *
+from .aio import *
+from .spatial import *
+from .analytics import *
+from .tracking import *
+from .metrics import *
+from .export import *
+from .shard import *
+from .cache import *
+from .replay import *
+from .alerts import *
@@ -0,0 +1,86 @@
+# Imports
+from __future__ import annotations
+import math
+import random
+import asyncio
+from dataclasses import dataclass
+from typing import Optional
+
+from .nextbike import Client
+
+__all__ = ["AsyncClient", "run_scraper"]
+
+
+@dataclass
+class AsyncClient(Client):
+    '''Client with an asyncio based scraper.
+
+    Fetching, parsing and log writes run in worker threads, so the event loop only schedules.'''
+
+    async def scrape(self, interval_secs: float,
+                     country_codes: list[str] = [],
+                     organization_names: list[str] = [],
+                     city_ids: list[int] = [],
+                     station_ids: list[int] = [],
+                     bike_ids: list[int] = [],
+                     stream: bool = False,
+                     overrun: str = "skip",
+                     max_backoff_secs: float = 300,
+                     max_scrapes: Optional[int] = None) -> int:
+        '''Scrape at a fixed rate until cancelled or max_scrapes is reached. Returns the number of scrapes.
+
+        Ticks are scheduled at start + n * interval_secs, so the schedule does not drift by the
+        time spent fetching and logging. If a tick takes longer than the interval, overrun="skip"
+        drops the missed ticks and continues on the schedule, overrun="queue" runs them back to back.
+        Failed fetches are retried after an exponential backoff with full jitter. The buffered history
+        is written when scraping ends, also if it is cancelled.'''
+        if overrun not in ("skip", "queue"):
+            raise ValueError(f"Unknown overrun policy '{overrun}'. Choose from 'skip' or 'queue'.")
+        try:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            tick = 0
+            failures = 0
+            scrape_count = 0
+            while max_scrapes is None or scrape_count < max_scrapes:
+                if self.metrics is not None:
+                    self.metrics.observe("scrape_lag_seconds", max(0.0, loop.time() - (start + tick * interval_secs)))
+                try:
+                    ok = await asyncio.to_thread(self._scrape_tick, country_codes, organization_names, city_ids,
+                                                 station_ids, bike_ids, stream)
+                except Exception as e:
+                    print(f"Scraping failed: {e}")
+                    if self.metrics is not None:
+                        self.metrics.inc("scrapes_total", result="failed")
+                    ok = False
+
+                if not ok:
+                    failures += 1
+                    # The exponent is capped, the backoff would overflow a float after about a thousand failures
+                    backoff = min(max_backoff_secs, interval_secs * 2 ** min(failures - 1, 30))
+                    await asyncio.sleep(random.uniform(0, backoff))
+                    continue
+                failures = 0
+                scrape_count += 1
+                print(100 * " ", end="\r")
+                print(f"\rScraped: {scrape_count}", end="")
+                if scrape_count == max_scrapes:
+                    break
+
+                tick += 1
+                now = loop.time()
+                if overrun == "skip" and start + tick * interval_secs < now:
+                    tick = math.ceil((now - start) / interval_secs)
+                await asyncio.sleep(max(0, start + tick * interval_secs - loop.time()))
+            return scrape_count
+        finally:  # Also on cancellation
+            self.flush()
+
+
+def run_scraper(client: AsyncClient, interval_secs: float, **kwargs) -> int:
+    '''Run AsyncClient.scrape in a new event loop until it finishes or is interrupted.'''
+    try:
+        return asyncio.run(client.scrape(interval_secs, **kwargs))
+    except KeyboardInterrupt:
+        print("\nScraping stopped.")
+        return 0
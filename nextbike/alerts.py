@@ -0,0 +1,244 @@
+# Imports
+from __future__ import annotations
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from .diff import Snapshot, SnapshotDiff, diff
+
+__all__ = [
+    "AlertEngine",
+    "Rule",
+    "Alert",
+    "StationState",
+    "CityState",
+    "station_empty",
+    "station_full",
+    "city_dropped_by",
+]
+
+
+@dataclass(frozen=True, slots=True)
+class StationState:
+    id: int
+    free_racks: int
+    bikes_available_to_rent: int
+
+
+@dataclass(frozen=True, slots=True)
+class CityState:
+    '''baseline is the highest number of available bikes since the rule last resolved for this city.'''
+    id: int
+    available_bikes: int
+    baseline: int
+
+
+@dataclass(eq=False)
+class Rule:
+    '''A condition on stations or cities, fired once it held for for_duration.
+
+    kind is "stations" or "cities", ids the watched ids or None for all of them. callback gets the
+    Alert when the rule fires, on_resolve when the condition of a fired alert no longer holds.'''
+    kind: str
+    condition: Callable[[StationState | CityState], bool]
+    callback: Callable[[Alert], None]
+    ids: Optional[frozenset[int]] = None
+    for_duration: timedelta = timedelta(0)
+    on_resolve: Optional[Callable[[Alert], None]] = None
+    name: str = ""
+
+
+@dataclass
+class Alert:
+    '''since is when the condition was first seen to hold, fired_at when the alert fired.'''
+    rule: Rule
+    id: int
+    since: datetime
+    fired_at: datetime
+    state: StationState | CityState
+
+
+def station_empty(station: StationState) -> bool:
+    return station.bikes_available_to_rent == 0
+
+
+def station_full(station: StationState) -> bool:
+    return station.free_racks == 0
+
+
+def city_dropped_by(fraction: float) -> Callable[[CityState], bool]:
+    '''City condition: available bikes dropped by at least fraction, e.g. 0.3, below the baseline.'''
+    return lambda city: city.baseline > 0 and city.available_bikes <= (1 - fraction) * city.baseline
+
+
+class AlertEngine:
+    '''Evaluates rules on stations and cities incrementally from the changes between fetches.
+
+    Rules are indexed by the station and city ids they watch, so an update only evaluates the rules
+    of changed, added and removed stations and cities, plus the rules watching all of them. Removed
+    entities count as not matching. Conditions that have to hold for a duration wait in a heap ordered
+    by deadline and fire on the first update at or after it, unless a change in between ended them.
+    Callbacks run on the thread calling update, i.e. the fetching one for Client.subscribe.'''
+
+    def __init__(self):
+        self.rules: list[Rule] = []
+        self.previous: Optional[Snapshot] = None
+        # kind -> id -> current values, kept up to date from the diffs
+        self.values: dict[str, dict[int, tuple | int]] = {"stations": dict(), "cities": dict()}
+        self._index: dict[str, dict[int, list[Rule]]] = {"stations": dict(), "cities": dict()}
+        self._unfiltered: dict[str, list[Rule]] = {"stations": [], "cities": []}
+        # (rule, id) -> since, for conditions holding but not yet for long enough
+        self._pending: dict[tuple[Rule, int], datetime] = dict()
+        self._deadlines: list[tuple[datetime, int, Rule, int, datetime]] = []
+        self._firing: dict[tuple[Rule, int], Alert] = dict()
+        self._baselines: dict[tuple[Rule, int], int] = dict()
+        self._sequence = itertools.count()
+        self._now: Optional[datetime] = None
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def add(self, rule: Rule) -> Rule:
+        '''Register a rule. It is evaluated against the last update right away.'''
+        if rule.kind not in self._index:
+            raise ValueError(f"Unknown kind '{rule.kind}'. Choose from {list(self._index)}.")
+        self.rules.append(rule)
+        if rule.ids is None:
+            self._unfiltered[rule.kind].append(rule)
+        else:
+            for id in rule.ids:
+                self._index[rule.kind].setdefault(id, []).append(rule)
+        if self._now is not None:
+            values = self.values[rule.kind]
+            for id in list(values if rule.ids is None else rule.ids):
+                self._evaluate(rule, id, values.get(id), self._now)
+        return rule
+
+    def remove(self, rule: Rule):
+        '''Unregister a rule. Its pending and fired alerts are dropped without resolving.'''
+        self.rules.remove(rule)
+        if rule.ids is None:
+            self._unfiltered[rule.kind].remove(rule)
+        else:
+            for id in rule.ids:
+                rules = self._index[rule.kind][id]
+                rules.remove(rule)
+                if not rules:
+                    del self._index[rule.kind][id]
+        for state in (self._pending, self._firing, self._baselines):
+            for key in [key for key in state if key[0] is rule]:
+                del state[key]
+
+    def firing(self) -> list[Alert]:
+        '''Alerts fired and not resolved yet.'''
+        return list(self._firing.values())
+
+    # ------------------------ evaluation -------------------------------------
+    def update(self, snapshot: Snapshot) -> list[Alert]:
+        '''Diff a snapshot against the previous one and evaluate the touched rules. Returns the fired alerts.
+
+        Diffing snapshots scans all stations, prefer apply with the changes of a client if available.'''
+        previous, self.previous = self.previous, snapshot
+        if previous is None:
+            self.values = {"stations": dict(snapshot.stations), "cities": dict(snapshot.cities)}
+            self._now = snapshot.timestamp
+            fired = []
+            for kind in ("stations", "cities"):
+                values = getattr(snapshot, kind)
+                ids = values.keys() if self._unfiltered[kind] else values.keys() & self._index[kind].keys()
+                for id in ids:
+                    self._evaluate_id(kind, id, values[id], snapshot.timestamp, fired)
+            return fired + self.check(snapshot.timestamp)
+        return self.apply(diff(previous, snapshot))
+
+    def apply(self, d: SnapshotDiff) -> list[Alert]:
+        '''Evaluate the rules touched by the changes of a diff, e.g. client.changes(). Returns the fired alerts.'''
+        fired = []
+        now = self._now = d.current
+        stations, cities = self.values["stations"], self.values["cities"]
+        for change in d.stations_changed:
+            values = stations[change.id] = (change.free_racks[1], change.bikes_available_to_rent[1])
+            self._evaluate_id("stations", change.id, values, now, fired)
+        for id, values in d.stations_added.items():
+            stations[id] = values
+            self._evaluate_id("stations", id, values, now, fired)
+        for id in d.stations_removed:
+            stations.pop(id, None)
+            self._evaluate_id("stations", id, None, now, fired)
+        for change in d.cities_changed:
+            cities[change.id] = change.available_bikes[1]
+            self._evaluate_id("cities", change.id, change.available_bikes[1], now, fired)
+        return fired + self.check(now)
+
+    def check(self, now: datetime) -> list[Alert]:
+        '''Fire the pending alerts whose condition held for long enough by now. Returns the fired alerts.'''
+        fired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, rule, id, since = heapq.heappop(self._deadlines)
+            key = (rule, id)
+            if self._pending.get(key) != since:  # Ended or removed in the meantime
+                continue
+            del self._pending[key]
+            values = self.values[rule.kind].get(id)
+            if values is not None:
+                fired.append(self._fire(rule, id, since, now, self._state(rule, id, values)))
+        return fired
+
+    def _evaluate_id(self, kind: str, id: int, values: Optional[tuple | int], now: datetime, fired: list[Alert]):
+        for rule in itertools.chain(self._index[kind].get(id, ()), self._unfiltered[kind]):
+            alert = self._evaluate(rule, id, values, now)
+            if alert is not None:
+                fired.append(alert)
+
+    def _evaluate(self, rule: Rule, id: int, values: Optional[tuple | int], now: datetime) -> Optional[Alert]:
+        key = (rule, id)
+        state = None if values is None else self._state(rule, id, values)
+        if state is not None and _holds(rule, state):
+            if key in self._firing or key in self._pending:
+                return None
+            if rule.for_duration <= timedelta(0):
+                return self._fire(rule, id, now, now, state)
+            self._pending[key] = now
+            heapq.heappush(self._deadlines, (now + rule.for_duration, next(self._sequence), rule, id, now))
+            return None
+        self._pending.pop(key, None)
+        alert = self._firing.pop(key, None)
+        if rule.kind == "cities":
+            if values is None:
+                self._baselines.pop(key, None)
+            elif alert is not None:
+                self._baselines[key] = values
+        if alert is not None and rule.on_resolve is not None:
+            _call(rule.on_resolve, alert)
+        return None
+
+    def _state(self, rule: Rule, id: int, values: tuple | int) -> StationState | CityState:
+        if rule.kind == "stations":
+            return StationState(id, *values)
+        key = (rule, id)
+        baseline = max(self._baselines.get(key, values), values)
+        self._baselines[key] = baseline
+        return CityState(id, values, baseline)
+
+    def _fire(self, rule: Rule, id: int, since: datetime, now: datetime,
+              state: StationState | CityState) -> Alert:
+        alert = self._firing[(rule, id)] = Alert(rule, id, since, now, state)
+        _call(rule.callback, alert)
+        return alert
+
+
+def _holds(rule: Rule, state: StationState | CityState) -> bool:
+    try:
+        return bool(rule.condition(state))
+    except Exception as e:
+        print(f"Alert condition {rule.name or rule.condition} failed: {e}")
+        return False
+
+
+def _call(callback: Callable[[Alert], None], alert: Alert):
+    try:
+        callback(alert)
+    except Exception as e:
+        print(f"Alert callback failed: {e}")
@@ -0,0 +1,239 @@
+# Imports
+from __future__ import annotations
+from datetime import datetime, timedelta
+from typing import Iterable
+
+import numpy as np
+
+from .nextbike import Country, Organization, City
+
+__all__ = ["Aggregator", "aggregate"]
+
+
+class Aggregator:
+    '''Incremental, windowed occupancy, turnover and utilisation metrics over snapshots.
+
+    Snapshots of cities, organizations or countries are added in timestamp order, e.g. from
+    client.history.city(id, start, end) or after every fetch. They are buffered and processed
+    chunk wise with vectorized group-bys. Only the last sample of every station and the last station
+    of every bike are kept between chunks, so memory only grows with the number of windows, which
+    can be drained with pop_completed.
+
+    Per station and window:
+        mean_bikes     : mean bikes_available_to_rent over the samples
+        empty_minutes  : time with no bikes available to rent
+        full_minutes   : time with no free racks
+        departures     : bikes that left the station and were seen at another station later, counted in
+                         the window they were last seen at the station
+    Per city and window:
+        mean_available_bikes, fleet (distinct bikes seen so far) and utilisation = 1 - mean / fleet
+
+    Time between two samples is attributed to the window of the earlier sample. Gaps longer than
+    max_gap, e.g. scraper downtime, are not counted. Departures of bikes seen again after their
+    window was drained are counted in the first window not drained yet.'''
+
+    def __init__(self, window: timedelta = timedelta(hours=1), max_gap: timedelta = timedelta(minutes=15),
+                 chunksize: int = 256):
+        self.window = window.total_seconds()
+        self.max_gap = max_gap.total_seconds()
+        self.chunksize = chunksize
+        self._buffer: list[tuple] = []
+        self._latest = -np.inf
+        # Last sample per station: t, station, bikes, free racks
+        self._station_carry = tuple(np.zeros(0) for _ in range(4))
+        # Last seen station per bike: t, bike, station
+        self._bike_carry = tuple(np.zeros(0) for _ in range(3))
+        self._station_city: dict[int, int] = dict()
+        self._fleet: dict[int, set[int]] = dict()
+        # (station, window) -> [bike sum, samples, empty secs, full secs, departures]
+        self._stations: dict[tuple[int, int], list] = dict()
+        # (city, window) -> [available bike sum, samples, fleet]
+        self._cities: dict[tuple[int, int], list] = dict()
+        # First window not drained by pop_completed
+        self._drained = np.iinfo(np.int64).min
+
+    # ------------------------ input ------------------------------------------
+    def add(self, timestamp: datetime, obj: Country | Organization | City):
+        '''Add a snapshot. Snapshots have to be added in timestamp order.'''
+        t = timestamp.timestamp()
+        self._latest = t
+        cities = list(obj.cities.values()) if hasattr(obj, "cities") else [obj]
+        city_rows, station_rows, bike_rows = [], [], []
+        for city in cities:
+            city_rows.append((city.id, city.available_bikes))
+            for station in city.stations.values():
+                self._station_city[station.id] = city.id
+                station_rows.append((station.id, station.bikes_available_to_rent, station.free_racks))
+                bike_rows.extend((bike_id, station.id) for bike_id in station.bikes)
+            self._fleet.setdefault(city.id, set()).update(bike for s in city.stations.values() for bike in s.bikes)
+        self._buffer.append((t, np.array(city_rows, dtype=np.int64).reshape(-1, 2),
+                             np.array(station_rows, dtype=np.int64).reshape(-1, 3),
+                             np.array(bike_rows, dtype=np.int64).reshape(-1, 2)))
+        if len(self._buffer) >= self.chunksize:
+            self.flush()
+
+    def add_many(self, snapshots: Iterable[tuple[datetime, Country | Organization | City]]):
+        '''Add (timestamp, snapshot) pairs, e.g. from client.history.city(...).'''
+        for timestamp, obj in snapshots:
+            self.add(timestamp, obj)
+        self.flush()
+
+    def flush(self):
+        '''Process the buffered snapshots.'''
+        if not self._buffer:
+            return
+        buffer, self._buffer = self._buffer, []
+        self._process_cities(buffer)
+        self._process_stations(buffer)
+        self._process_bikes(buffer)
+
+    # ------------------------ output -----------------------------------------
+    def station_metrics(self) -> dict[str, np.ndarray]:
+        '''Metrics per station and window, sorted by station and window.'''
+        self.flush()
+        return self._station_table(sorted(self._stations))
+
+    def city_metrics(self) -> dict[str, np.ndarray]:
+        '''Metrics per city and window, sorted by city and window.'''
+        self.flush()
+        return self._city_table(sorted(self._cities))
+
+    def pop_completed(self, before: datetime) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+        '''Remove and return the (station, city) metrics of all windows ending before a timestamp.
+
+        Windows of carried samples stay until the next sample of their station added its gap time.'''
+        self.flush()
+        last = before.timestamp() // self.window
+        carry_t = self._station_carry[0]
+        open_t = carry_t[carry_t >= self._latest - self.max_gap]  # Older ones get no more gap time
+        if len(open_t):
+            last = min(last, open_t.min() // self.window)
+        self._drained = max(self._drained, int(last))
+        station_keys = sorted(k for k in self._stations if k[1] < last)
+        city_keys = sorted(k for k in self._cities if k[1] < last)
+        result = self._station_table(station_keys), self._city_table(city_keys)
+        for k in station_keys:
+            del self._stations[k]
+        for k in city_keys:
+            del self._cities[k]
+        return result
+
+    def _station_table(self, keys: list[tuple[int, int]]) -> dict[str, np.ndarray]:
+        values = np.array([self._stations[k] for k in keys], dtype=np.float64).reshape(-1, 5)
+        keys = np.array(keys, dtype=np.int64).reshape(-1, 2)
+        return {
+            "station_id": keys[:, 0],
+            "city_id": np.array([self._station_city.get(k, -1) for k in keys[:, 0].tolist()], dtype=np.int64),
+            "window_start": self._window_start(keys[:, 1]),
+            "samples": values[:, 1].astype(np.int64),
+            "mean_bikes": values[:, 0] / np.maximum(values[:, 1], 1),
+            "empty_minutes": values[:, 2] / 60,
+            "full_minutes": values[:, 3] / 60,
+            "departures": values[:, 4].astype(np.int64),
+        }
+
+    def _city_table(self, keys: list[tuple[int, int]]) -> dict[str, np.ndarray]:
+        values = np.array([self._cities[k] for k in keys], dtype=np.float64).reshape(-1, 3)
+        keys = np.array(keys, dtype=np.int64).reshape(-1, 2)
+        mean = values[:, 0] / np.maximum(values[:, 1], 1)
+        return {
+            "city_id": keys[:, 0],
+            "window_start": self._window_start(keys[:, 1]),
+            "samples": values[:, 1].astype(np.int64),
+            "mean_available_bikes": mean,
+            "fleet": values[:, 2].astype(np.int64),
+            "utilisation": np.where(values[:, 2] > 0, 1 - mean / np.maximum(values[:, 2], 1), np.nan),
+        }
+
+    def _window_start(self, windows: np.ndarray) -> np.ndarray:
+        '''Start of windows as UTC datetime64.'''
+        return (windows * self.window * 1e6).astype("datetime64[us]")
+
+    # ------------------------ processing -------------------------------------
+    def _process_cities(self, buffer: list[tuple]):
+        t = np.concatenate([np.full(len(c), t) for t, c, _, _ in buffer])
+        rows = np.concatenate([c for _, c, _, _ in buffer])
+        if not len(rows):
+            return
+        keys, inverse = np.unique(np.stack([rows[:, 0], (t // self.window).astype(np.int64)], axis=1),
+                                  axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        sums = np.bincount(inverse, weights=rows[:, 1])
+        counts = np.bincount(inverse)
+        for (city, window), s, n in zip(keys.tolist(), sums.tolist(), counts.tolist()):
+            acc = self._cities.setdefault((city, window), [0.0, 0, 0])
+            acc[0] += s
+            acc[1] += n
+            acc[2] = len(self._fleet.get(city, ()))
+
+    def _process_stations(self, buffer: list[tuple]):
+        new_t = np.concatenate([np.full(len(s), t) for t, _, s, _ in buffer])
+        new = np.concatenate([s for _, _, s, _ in buffer])
+        carry_t, carry_id, carry_bikes, carry_free = self._station_carry
+        n_carry = len(carry_t)
+        t = np.concatenate([carry_t, new_t])
+        sid = np.concatenate([carry_id, new[:, 0]]).astype(np.int64)
+        bikes = np.concatenate([carry_bikes, new[:, 1]])
+        free = np.concatenate([carry_free, new[:, 2]])
+        fresh = np.r_[np.zeros(n_carry, dtype=bool), np.ones(len(new), dtype=bool)]
+        order = np.lexsort((t, sid))
+        t, sid, bikes, free, fresh = t[order], sid[order], bikes[order], free[order], fresh[order]
+        if not len(t):
+            return
+
+        # Duration until the next sample of the same station
+        same = np.r_[sid[1:] == sid[:-1], False]
+        dt = np.where(same, np.r_[t[1:] - t[:-1], 0], 0)
+        dt[dt > self.max_gap] = 0
+        windows = (t // self.window).astype(np.int64)
+        keys, inverse = np.unique(np.stack([sid, windows], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        n = len(keys)
+        bike_sum = np.bincount(inverse, weights=bikes * fresh, minlength=n)
+        samples = np.bincount(inverse, weights=fresh, minlength=n)
+        empty = np.bincount(inverse, weights=dt * (bikes == 0), minlength=n)
+        full = np.bincount(inverse, weights=dt * (free == 0), minlength=n)
+        for key, b, c, e, f in zip(map(tuple, keys.tolist()), bike_sum.tolist(), samples.tolist(),
+                                   empty.tolist(), full.tolist()):
+            acc = self._stations.setdefault(key, [0.0, 0, 0.0, 0.0, 0])
+            acc[0] += b
+            acc[1] += c
+            acc[2] += e
+            acc[3] += f
+
+        last = ~same
+        self._station_carry = (t[last], sid[last], bikes[last], free[last])
+
+    def _process_bikes(self, buffer: list[tuple]):
+        new_t = np.concatenate([np.full(len(b), t) for t, _, _, b in buffer])
+        new = np.concatenate([b for _, _, _, b in buffer])
+        carry_t, carry_id, carry_station = self._bike_carry
+        t = np.concatenate([carry_t, new_t])
+        bid = np.concatenate([carry_id, new[:, 0]]).astype(np.int64)
+        station = np.concatenate([carry_station, new[:, 1]]).astype(np.int64)
+        order = np.lexsort((t, bid))
+        t, bid, station = t[order], bid[order], station[order]
+        if not len(t):
+            return
+
+        # A bike seen at another station than before made a trip starting at the earlier station, counted
+        # in the window it was last seen there, or the first one not drained yet
+        moved = np.r_[False, (bid[1:] == bid[:-1]) & (station[1:] != station[:-1])]
+        origin = np.r_[0, station[:-1]][moved]
+        windows = np.maximum((np.r_[0, t[:-1]][moved] // self.window).astype(np.int64), self._drained)
+        if len(origin):
+            keys, counts = np.unique(np.stack([origin, windows], axis=1), axis=0, return_counts=True)
+            for key, count in zip(map(tuple, keys.tolist()), counts.tolist()):
+                self._stations.setdefault(key, [0.0, 0, 0.0, 0.0, 0])[4] += count
+
+        last = np.r_[bid[1:] != bid[:-1], True]
+        self._bike_carry = (t[last], bid[last], station[last])
+
+
+def aggregate(snapshots: Iterable[tuple[datetime, Country | Organization | City]],
+              window: timedelta = timedelta(hours=1),
+              max_gap: timedelta = timedelta(minutes=15)) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+    '''Station and city metrics of (timestamp, snapshot) pairs, see Aggregator.'''
+    aggregator = Aggregator(window, max_gap)
+    aggregator.add_many(snapshots)
+    return aggregator.station_metrics(), aggregator.city_metrics()
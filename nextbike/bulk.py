@@ -0,0 +1,84 @@
+# Imports
+from __future__ import annotations
+import os
+import json
+import mmap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .history import parse_log_timestamp
+from .nextbike import Country, Organization, City, Station, Bike
+
+__all__ = ["load_many", "iter_many"]
+
+
+_kinds = {
+    "country": Country,
+    "organization": Organization,
+    "city": City,
+    "station": Station,
+    "bike": Bike,
+}
+
+
+def load_many(paths: str | Iterable[str], kind: str = "city", workers: Optional[int] = None,
+              chunksize: int = 64) -> list[tuple[datetime, Country | Organization | City | Station | Bike]]:
+    '''Load many logfiles of one kind in parallel. Returns (timestamp, object) pairs in timestamp order.
+
+    paths is either a list of logfiles or a logfile folder. kind is one of
+    "country", "organization", "city", "station" or "bike".'''
+    return list(iter_many(paths, kind, workers, chunksize))
+
+
+def iter_many(paths: str | Iterable[str], kind: str = "city", workers: Optional[int] = None,
+              chunksize: int = 64) -> Iterator[tuple[datetime, Country | Organization | City | Station | Bike]]:
+    '''Streaming version of load_many.
+
+    The files are decoded chunk by chunk in a process pool. Only a few chunks per worker are in
+    flight at a time, so memory stays flat no matter how many files are loaded.'''
+    if kind not in _kinds:
+        raise ValueError(f"Unknown kind '{kind}'. Choose from {list(_kinds)}.")
+    if isinstance(paths, str):
+        paths = [os.path.join(paths, name) for name in os.listdir(paths)
+                 if name.startswith("log_") and name.endswith(".json")]
+    paths = sorted(paths, key=parse_log_timestamp)
+    chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield from _load_chunk(chunk, kind)
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_load_chunk, chunk, kind))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _load_chunk(paths: list[str], kind: str) -> list[tuple[datetime, Country | Organization | City | Station | Bike]]:
+    cls = _kinds[kind]
+    return [(parse_log_timestamp(path), cls.from_dict(_read_json(path))) for path in paths]
+
+
+def _read_json(path: str) -> dict:
+    '''Read a logfile through mmap and decode it with orjson if installed.'''
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"Logfile {path} is empty.")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if orjson is not None:
+                with memoryview(m) as view:
+                    return orjson.loads(view)
+            return json.loads(m[:])
@@ -0,0 +1,128 @@
+# Imports
+from __future__ import annotations
+import sys
+import bisect
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from .nextbike import Client
+
+__all__ = ["SnapshotCache"]
+
+
+class SnapshotCache:
+    '''In-memory cache of the data of recent fetches.
+
+    Holds at most max_snapshots snapshots, none older than max_age before the newest one, and about
+    max_bytes of memory. Over budget the least recently used snapshots are evicted, the newest one is
+    always kept. Clients reuse the unchanged cities, stations and bikes of the previous fetch, so
+    consecutive snapshots share them. Each snapshot counts the objects it does not share with the
+    cached snapshot before it, so when a snapshot is removed, the one after it is counted again
+    against its new predecessor and takes over the objects that are still shared. Cached objects
+    must not be modified.'''
+
+    def __init__(self, max_snapshots: Optional[int] = 60, max_age: Optional[timedelta] = None,
+                 max_bytes: Optional[int] = None):
+        self.max_snapshots = max_snapshots
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._timestamps: list[datetime] = []
+        # timestamp -> (client fields, estimated bytes), in least recently used order
+        self._entries: OrderedDict[datetime, tuple[dict, int]] = OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self._timestamps)
+
+    def timestamps(self) -> list[datetime]:
+        return list(self._timestamps)
+
+    def add(self, timestamp: datetime, client: Client):
+        '''Cache the current data of a client.'''
+        state = {
+            "countries": client.countries,
+            "organizations": client.organizations,
+            "cities": client.cities,
+            "stations": client.stations,
+            "bikes": client.bikes,
+            "columns": client.columns,
+        }
+        if timestamp in self._entries:
+            self._remove(timestamp)
+        i = bisect.bisect_left(self._timestamps, timestamp)
+        self._timestamps.insert(i, timestamp)
+        self._entries[timestamp] = (state, 0)
+        self._resize(i)
+        if i + 1 < len(self._timestamps):
+            self._resize(i + 1)
+        self._evict()
+
+    def at(self, timestamp: datetime) -> Client:
+        '''The cached data at a time, i.e. of the latest fetch not after it, as a client.'''
+        i = bisect.bisect_right(self._timestamps, timestamp)
+        if i == 0:
+            raise KeyError(f"No cached snapshot at {timestamp}.")
+        return self._client(self._timestamps[i - 1])
+
+    def window(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> list[tuple[datetime, Client]]:
+        '''(timestamp, client) pairs of all cached snapshots with start <= timestamp <= end.'''
+        first = 0 if start is None else bisect.bisect_left(self._timestamps, start)
+        stop = len(self._timestamps) if end is None else bisect.bisect_right(self._timestamps, end)
+        return [(t, self._client(t)) for t in self._timestamps[first:stop]]
+
+    def _client(self, timestamp: datetime) -> Client:
+        self._entries.move_to_end(timestamp)
+        return Client(**self._entries[timestamp][0], fetched_at=timestamp)
+
+    def _evict(self):
+        newest = self._timestamps[-1]
+        if self.max_age is not None:
+            while self._timestamps[0] < newest - self.max_age:
+                self._remove(self._timestamps[0])
+        while len(self._timestamps) > 1 and (
+                (self.max_snapshots is not None and len(self._timestamps) > self.max_snapshots) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            lru = next(t for t in self._entries if t != newest)
+            self._remove(lru)
+
+    def _remove(self, timestamp: datetime):
+        _, size = self._entries.pop(timestamp)
+        i = bisect.bisect_left(self._timestamps, timestamp)
+        self._timestamps.pop(i)
+        self.nbytes -= size
+        if i < len(self._timestamps):
+            self._resize(i)
+
+    def _resize(self, i: int):
+        '''Count the i-th snapshot in time order against the one before it.'''
+        timestamp = self._timestamps[i]
+        state, old = self._entries[timestamp]
+        previous = self._entries[self._timestamps[i - 1]][0] if i > 0 else None
+        size = _estimate_bytes(state, previous)
+        self._entries[timestamp] = (state, size)  # Keeps the recently used order
+        self.nbytes += size - old
+
+
+def _estimate_bytes(state: dict, previous: Optional[dict]) -> int:
+    '''Approximate memory of a snapshot not shared with the previous one.'''
+    if state["columns"] is not None:
+        return state["columns"].nbytes
+    size = sum(sys.getsizeof(state[key]) for key in ("countries", "organizations", "cities", "stations", "bikes")
+               if state[key] is not None)
+    for key in ("cities", "stations", "bikes"):
+        objects = state[key] or dict()
+        shared = previous[key] if previous is not None and previous[key] is not None else dict()
+        new = [o for id, o in objects.items() if shared.get(id) is not o]
+        if new:
+            size += len(new) * _object_bytes(new[0])
+            if key != "bikes":  # The dictionaries of stations and bikes they hold
+                size += sum(sys.getsizeof(o.stations if key == "cities" else o.bikes) for o in new)
+    return size
+
+
+def _object_bytes(obj: object) -> int:
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
@@ -0,0 +1,258 @@
+# Imports
+from __future__ import annotations
+from array import array
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+from .utils import country_code_map
+from .nextbike import Country, Organization, City, Station, Bike
+
+__all__ = ["ColumnarSnapshot", "ColumnarBuilder"]
+
+
+@dataclass
+class ColumnarSnapshot:
+    '''Array backed snapshot of the nextbike data.
+
+    Every entity type is stored column wise in typed arrays. The offset arrays map each
+    organization to its cities, each city to its stations and each station to its bikes,
+    e.g. the stations of city i are station_*[city_station_offsets[i]:city_station_offsets[i + 1]].'''
+    # organizations
+    org_name: list[str]
+    org_country_name: list[str]
+    org_country_code: list[str]
+    org_lat: np.ndarray
+    org_lng: np.ndarray
+    org_city_offsets: np.ndarray
+    # cities
+    city_id: np.ndarray
+    city_name: list[str]
+    city_lat: np.ndarray
+    city_lng: np.ndarray
+    city_available_bikes: np.ndarray
+    city_org: np.ndarray
+    city_station_offsets: np.ndarray
+    # stations
+    station_id: np.ndarray
+    station_name: list[str]
+    station_number: np.ndarray
+    station_lat: np.ndarray
+    station_lng: np.ndarray
+    station_free_racks: np.ndarray
+    station_bikes_available_to_rent: np.ndarray
+    station_city: np.ndarray
+    station_bike_offsets: np.ndarray
+    # bikes
+    bike_id: np.ndarray
+    bike_type: np.ndarray
+    bike_active: np.ndarray
+    bike_state: np.ndarray
+    bike_station: np.ndarray
+    states: list[str]
+
+    _org_index: Optional[dict[str, int]] = field(default=None, init=False, repr=False, compare=False)
+    _city_index: Optional[dict[int, int]] = field(default=None, init=False, repr=False, compare=False)
+    _station_index: Optional[dict[int, int]] = field(default=None, init=False, repr=False, compare=False)
+    _bike_index: Optional[dict[int, int]] = field(default=None, init=False, repr=False, compare=False)
+
+    def __str__(self) -> str:
+        return "ColumnarSnapshot:\n" + \
+            f"\tOrganizations : {len(self.org_name)}\n" + \
+            f"\tCities        : {len(self.city_id)}\n" + \
+            f"\tStations      : {len(self.station_id)}\n" + \
+            f"\tBikes         : {len(self.bike_id)}\n" + \
+            f"\tBytes         : {self.nbytes}"
+
+    @property
+    def nbytes(self) -> int:
+        '''Memory used by the array columns.'''
+        return sum(v.nbytes for v in vars(self).values() if isinstance(v, np.ndarray))
+
+    # ------------------------ columns ----------------------------------------
+    def column(self, name: str) -> np.ndarray:
+        '''Get a whole column, e.g. "station_lat" or "bike_state".'''
+        col = getattr(self, name, None)
+        if not isinstance(col, np.ndarray):
+            raise KeyError(f"No column named '{name}'.")
+        return col
+
+    def station_mask(self, country_code: Optional[str] = None,
+                     organization_name: Optional[str] = None,
+                     city_id: Optional[int] = None) -> np.ndarray:
+        '''Boolean mask over the station columns selecting a country, organization and/or city.'''
+        city_mask = np.ones(len(self.city_id), dtype=bool)
+        if country_code is not None:
+            org_mask = np.array([code == country_code for code in self.org_country_code], dtype=bool)
+            city_mask &= org_mask[self.city_org]
+        if organization_name is not None:
+            city_mask &= self.city_org == self._org_idx(organization_name)
+        if city_id is not None:
+            city_mask &= self.city_id == city_id
+        return city_mask[self.station_city]
+
+    def bike_mask(self, **kwargs) -> np.ndarray:
+        '''Boolean mask over the bike columns, see station_mask.'''
+        return self.station_mask(**kwargs)[self.bike_station]
+
+    # ------------------------ views ------------------------------------------
+    def bike(self, bike_id: int) -> Bike:
+        '''Get data of a specific bike.'''
+        if self._bike_index is None:
+            self._bike_index = {id: i for i, id in enumerate(self.bike_id.tolist())}
+        return self._bike(self._bike_index[bike_id])
+
+    def station(self, station_id: int) -> Station:
+        '''Get data of a specific station.'''
+        if self._station_index is None:
+            self._station_index = {id: i for i, id in enumerate(self.station_id.tolist())}
+        return self._station(self._station_index[station_id])
+
+    def city(self, city_id: int) -> City:
+        '''Get data of a specific city.'''
+        if self._city_index is None:
+            self._city_index = {id: i for i, id in enumerate(self.city_id.tolist())}
+        return self._city(self._city_index[city_id])
+
+    def organization(self, organization_name: str) -> Organization:
+        '''Get data of a specific organization.'''
+        i = self._org_idx(organization_name)
+        cities = self._cities(range(self.org_city_offsets[i], self.org_city_offsets[i + 1]))
+        return Organization(self.org_name[i], self.org_country_name[i], self.org_country_code[i],
+                            float(self.org_lat[i]), float(self.org_lng[i]), cities)
+
+    def country(self, country_code: str) -> Country:
+        '''Get data of a specific country.'''
+        orgs = [i for i, code in enumerate(self.org_country_code) if code == country_code]
+        if not orgs:
+            raise KeyError(country_code)
+        lat, lng = country_code_map[country_code]
+        country = Country(self.org_country_name[orgs[0]], country_code, lat, lng, dict())
+        for i in orgs:
+            for city in self._cities(range(self.org_city_offsets[i], self.org_city_offsets[i + 1])).values():
+                country._add_city(city)
+        return country
+
+    @property
+    def organization_names(self) -> list[str]:
+        return list(self.org_name)
+
+    @property
+    def country_codes(self) -> list[str]:
+        return list(dict.fromkeys(self.org_country_code))
+
+    def _org_idx(self, organization_name: str) -> int:
+        if self._org_index is None:
+            self._org_index = {name: i for i, name in enumerate(self.org_name)}
+        return self._org_index[organization_name]
+
+    def _bike(self, i: int) -> Bike:
+        s = self.bike_station[i]
+        return Bike(int(self.bike_id[i]), int(self.bike_type[i]), bool(self.bike_active[i]),
+                    self.states[self.bike_state[i]], float(self.station_lat[s]), float(self.station_lng[s]))
+
+    def _station(self, i: int) -> Station:
+        bikes = dict()
+        for j in range(self.station_bike_offsets[i], self.station_bike_offsets[i + 1]):
+            bike = self._bike(j)
+            bikes[bike.id] = bike
+        return Station(int(self.station_id[i]), self.station_name[i], int(self.station_number[i]),
+                       float(self.station_lat[i]), float(self.station_lng[i]), int(self.station_free_racks[i]),
+                       int(self.station_bikes_available_to_rent[i]), bikes)
+
+    def _city(self, i: int) -> City:
+        stations = dict()
+        for j in range(self.city_station_offsets[i], self.city_station_offsets[i + 1]):
+            station = self._station(j)
+            stations[station.id] = station
+        return City(int(self.city_id[i]), self.city_name[i], float(self.city_lat[i]), float(self.city_lng[i]),
+                    int(self.city_available_bikes[i]), stations)
+
+    def _cities(self, indices: range) -> dict[int, City]:
+        cities = dict()
+        for i in indices:
+            city = self._city(i)
+            cities[city.id] = city
+        return cities
+
+
+class ColumnarBuilder:
+    '''Incrementally collects organizations, cities, stations and bikes into a ColumnarSnapshot.
+
+    Entities have to be added depth first: every city belongs to the last added organization,
+    every station to the last added city and every bike to the last added station.'''
+
+    def __init__(self):
+        self.org_name, self.org_country_name, self.org_country_code = [], [], []
+        self.org_lat, self.org_lng, self.org_city_offsets = array("d"), array("d"), array("q")
+        self.city_id, self.city_name, self.city_lat, self.city_lng = array("q"), [], array("d"), array("d")
+        self.city_available_bikes, self.city_org, self.city_station_offsets = array("l"), array("l"), array("q")
+        self.station_id, self.station_name, self.station_number = array("q"), [], array("q")
+        self.station_lat, self.station_lng = array("d"), array("d")
+        self.station_free_racks, self.station_bikes_available_to_rent = array("l"), array("l")
+        self.station_city, self.station_bike_offsets = array("l"), array("q")
+        self.bike_id, self.bike_type, self.bike_active = array("q"), array("l"), array("b")
+        self.bike_state, self.bike_station = array("B"), array("l")
+        self.states: dict[str, int] = dict()
+
+    def add_organization(self, name: str, country_name: str, country_code: str, lat: float, lng: float):
+        self.org_name.append(name)
+        self.org_country_name.append(country_name)
+        self.org_country_code.append(country_code)
+        self.org_lat.append(lat)
+        self.org_lng.append(lng)
+        self.org_city_offsets.append(len(self.city_id))
+
+    def add_city(self, id: int, name: str, lat: float, lng: float, available_bikes: int):
+        self.city_id.append(id)
+        self.city_name.append(name)
+        self.city_lat.append(lat)
+        self.city_lng.append(lng)
+        self.city_available_bikes.append(available_bikes)
+        self.city_org.append(len(self.org_name) - 1)
+        self.city_station_offsets.append(len(self.station_id))
+
+    def add_station(self, id: int, name: str, number: int, lat: float, lng: float,
+                    free_racks: int, bikes_available_to_rent: int):
+        self.station_id.append(id)
+        self.station_name.append(name)
+        self.station_number.append(number)
+        self.station_lat.append(lat)
+        self.station_lng.append(lng)
+        self.station_free_racks.append(free_racks)
+        self.station_bikes_available_to_rent.append(bikes_available_to_rent)
+        self.station_city.append(len(self.city_id) - 1)
+        self.station_bike_offsets.append(len(self.bike_id))
+
+    def add_bike(self, id: int, type: int, active: bool, state: str):
+        if state not in self.states:
+            self.states[state] = len(self.states)
+        self.bike_id.append(id)
+        self.bike_type.append(type)
+        self.bike_active.append(active)
+        self.bike_state.append(self.states[state])
+        self.bike_station.append(len(self.station_id) - 1)
+
+    def build(self) -> ColumnarSnapshot:
+        def col(a: array, dtype) -> np.ndarray:
+            return np.frombuffer(a, dtype=a.typecode).astype(dtype) if len(a) else np.zeros(0, dtype=dtype)
+
+        def offsets(a: array, total: int) -> np.ndarray:
+            return np.append(col(a, np.int64), np.int64(total))
+
+        return ColumnarSnapshot(
+            self.org_name, self.org_country_name, self.org_country_code,
+            col(self.org_lat, np.float64), col(self.org_lng, np.float64),
+            offsets(self.org_city_offsets, len(self.city_id)),
+            col(self.city_id, np.int64), self.city_name,
+            col(self.city_lat, np.float64), col(self.city_lng, np.float64),
+            col(self.city_available_bikes, np.int32), col(self.city_org, np.int32),
+            offsets(self.city_station_offsets, len(self.station_id)),
+            col(self.station_id, np.int64), self.station_name, col(self.station_number, np.int64),
+            col(self.station_lat, np.float64), col(self.station_lng, np.float64),
+            col(self.station_free_racks, np.int32), col(self.station_bikes_available_to_rent, np.int32),
+            col(self.station_city, np.int32), offsets(self.station_bike_offsets, len(self.bike_id)),
+            col(self.bike_id, np.int64), col(self.bike_type, np.int32), col(self.bike_active, np.bool_),
+            col(self.bike_state, np.uint8), col(self.bike_station, np.int32),
+            list(self.states))
@@ -0,0 +1,203 @@
+# Imports
+from __future__ import annotations
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from .nextbike import Client, City
+
+# diff is left out, it would shadow the nextbike.diff module
+__all__ = ["Snapshot", "BikeMove", "BikeChange", "StationChange", "CityChange", "SnapshotDiff"]
+
+
+@dataclass
+class Snapshot:
+    '''Compact, id keyed state of all cities, stations and bikes of a client at one point in time.
+
+    cities   : city id    -> available bikes
+    stations : station id -> (free racks, bikes available to rent)
+    bikes    : bike id    -> (station id, state, active)'''
+    timestamp: datetime
+    cities: dict[int, int]
+    stations: dict[int, tuple[int, int]]
+    bikes: dict[int, tuple[int, str, bool]]
+
+    @classmethod
+    def from_client(cls, client: Client, timestamp: Optional[datetime] = None, bikes: bool = True) -> Snapshot:
+        '''Take a snapshot of the current data of a client. Without bikes only cities and stations are kept.'''
+        if timestamp is None:
+            timestamp = client.fetched_at or datetime.now()
+        if client.columns is not None:
+            col = client.columns
+            cities = dict(zip(col.city_id.tolist(), col.city_available_bikes.tolist()))
+            stations = dict(zip(col.station_id.tolist(),
+                                zip(col.station_free_racks.tolist(), col.station_bikes_available_to_rent.tolist())))
+            if not bikes:
+                return cls(timestamp, cities, stations, dict())
+            states = [col.states[code] for code in col.bike_state.tolist()]
+            bike_values = dict(zip(col.bike_id.tolist(),
+                                   zip(col.station_id[col.bike_station].tolist(), states, col.bike_active.tolist())))
+            return cls(timestamp, cities, stations, bike_values)
+
+        if client.cities is None:
+            raise ValueError("No data available. Fetch data first.")
+        cities = dict()
+        stations = dict()
+        bike_values = dict()
+        for city in client.cities.values():
+            cities[city.id] = city.available_bikes
+            for station in city.stations.values():
+                stations[station.id] = (station.free_racks, station.bikes_available_to_rent)
+                if bikes:
+                    for bike in station.bikes.values():
+                        bike_values[bike.id] = (station.id, bike.state, bike.active)
+        return cls(timestamp, cities, stations, bike_values)
+
+
+@dataclass
+class BikeMove:
+    id: int
+    from_station: int
+    to_station: int
+
+
+@dataclass
+class BikeChange:
+    id: int
+    station: int
+    state: tuple[str, str]
+    active: tuple[bool, bool]
+
+
+@dataclass
+class StationChange:
+    id: int
+    free_racks: tuple[int, int]
+    bikes_available_to_rent: tuple[int, int]
+
+
+@dataclass
+class CityChange:
+    id: int
+    available_bikes: tuple[int, int]
+
+
+@dataclass
+class SnapshotDiff:
+    '''Changes between two snapshots. Changed values are stored as (previous, current) tuples.'''
+    previous: datetime
+    current: datetime
+    bikes_added: dict[int, tuple[int, str, bool]] = field(default_factory=dict)
+    bikes_removed: dict[int, tuple[int, str, bool]] = field(default_factory=dict)
+    bikes_moved: list[BikeMove] = field(default_factory=list)
+    bikes_changed: list[BikeChange] = field(default_factory=list)
+    stations_added: dict[int, tuple[int, int]] = field(default_factory=dict)
+    stations_removed: dict[int, tuple[int, int]] = field(default_factory=dict)
+    stations_changed: list[StationChange] = field(default_factory=list)
+    cities_changed: list[CityChange] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.bikes_added) + len(self.bikes_removed) + len(self.bikes_moved) + \
+            len(self.bikes_changed) + len(self.stations_added) + len(self.stations_removed) + \
+            len(self.stations_changed) + len(self.cities_changed)
+
+    def __str__(self) -> str:
+        return "SnapshotDiff:\n" + \
+            f"\tFrom             : {self.previous}\n" + \
+            f"\tTo               : {self.current}\n" + \
+            f"\tBikes added      : {len(self.bikes_added)}\n" + \
+            f"\tBikes removed    : {len(self.bikes_removed)}\n" + \
+            f"\tBikes moved      : {len(self.bikes_moved)}\n" + \
+            f"\tBikes changed    : {len(self.bikes_changed)}\n" + \
+            f"\tStations added   : {len(self.stations_added)}\n" + \
+            f"\tStations removed : {len(self.stations_removed)}\n" + \
+            f"\tStations changed : {len(self.stations_changed)}\n" + \
+            f"\tCities changed   : {len(self.cities_changed)}"
+
+    @property
+    def changed_station_ids(self) -> set[int]:
+        '''Ids of all stations touched by this diff, including the stations bikes moved from and to.'''
+        ids = set(self.stations_added) | set(self.stations_removed)
+        ids.update(c.id for c in self.stations_changed)
+        ids.update(b[0] for b in self.bikes_added.values())
+        ids.update(b[0] for b in self.bikes_removed.values())
+        for move in self.bikes_moved:
+            ids.add(move.from_station)
+            ids.add(move.to_station)
+        return ids
+
+
+def diff(previous: Snapshot, current: Snapshot) -> SnapshotDiff:
+    '''Compute the changes from one snapshot to another using id keyed lookups.'''
+    d = SnapshotDiff(previous.timestamp, current.timestamp)
+
+    prev_bikes = previous.bikes
+    for id, bike in current.bikes.items():
+        prev = prev_bikes.get(id)
+        if prev == bike:
+            continue
+        if prev is None:
+            d.bikes_added[id] = bike
+            continue
+        if prev[0] != bike[0]:
+            d.bikes_moved.append(BikeMove(id, prev[0], bike[0]))
+        if prev[1] != bike[1] or prev[2] != bike[2]:
+            d.bikes_changed.append(BikeChange(id, bike[0], (prev[1], bike[1]), (prev[2], bike[2])))
+    for id in prev_bikes.keys() - current.bikes.keys():
+        d.bikes_removed[id] = prev_bikes[id]
+
+    prev_stations = previous.stations
+    for id, station in current.stations.items():
+        prev = prev_stations.get(id)
+        if prev == station:
+            continue
+        if prev is None:
+            d.stations_added[id] = station
+            continue
+        d.stations_changed.append(StationChange(id, (prev[0], station[0]), (prev[1], station[1])))
+    for id in prev_stations.keys() - current.stations.keys():
+        d.stations_removed[id] = prev_stations[id]
+
+    prev_cities = previous.cities
+    for id, available_bikes in current.cities.items():
+        prev = prev_cities.get(id)
+        if prev is not None and prev != available_bikes:
+            d.cities_changed.append(CityChange(id, (prev, available_bikes)))
+    return d
+
+
+def diff_trees(previous: dict[int, City], current: dict[int, City],
+               previous_time: datetime, current_time: datetime) -> SnapshotDiff:
+    '''Compute the changes between the city trees of two fetches of the same client.
+
+    Unchanged cities, stations and bikes are shared between consecutive fetches, see
+    Client._build_tree, so identical objects are skipped and only the changed ones are compared.
+    The work grows with the number of cities and changed stations, not with the number of bikes.'''
+    before = Snapshot(previous_time, dict(), dict(), dict())
+    after = Snapshot(current_time, dict(), dict(), dict())
+    for id, city in current.items():
+        prev = previous.get(id)
+        if prev is city:
+            continue
+        _add_changed(after, city, prev)
+        if prev is not None:
+            _add_changed(before, prev, city)
+    for id in previous.keys() - current.keys():
+        _add_changed(before, previous[id], None)
+    return diff(before, after)
+
+
+def _add_changed(snapshot: Snapshot, city: City, other: Optional[City]):
+    '''Add the values of a city and of its stations and bikes not shared with the other tree's city.'''
+    snapshot.cities[city.id] = city.available_bikes
+    other_stations = other.stations if other is not None else dict()
+    for station_id, station in city.stations.items():
+        other_station = other_stations.get(station_id)
+        if other_station is station:
+            continue
+        snapshot.stations[station_id] = (station.free_racks, station.bikes_available_to_rent)
+        other_bikes = other_station.bikes if other_station is not None else dict()
+        for bike_id, bike in station.bikes.items():
+            if other_bikes.get(bike_id) is not bike:
+                snapshot.bikes[bike_id] = (station_id, bike.state, bike.active)
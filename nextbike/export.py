@@ -0,0 +1,242 @@
+# Imports
+from __future__ import annotations
+import os
+import time
+from datetime import date, datetime
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    from pyarrow.fs import LocalFileSystem
+except ImportError:
+    pa = None
+
+if TYPE_CHECKING:
+    from .nextbike import Client
+
+__all__ = ["ArrowExporter", "read_table"]
+
+
+_formats = {"parquet": "parquet", "ipc": "arrow"}  # format -> file extension
+_tables = ("stations", "bikes")
+
+
+def _schemas() -> dict:
+    return {
+        "stations": pa.schema([
+            ("timestamp", pa.timestamp("us")),
+            ("organization", pa.string()),
+            ("city_id", pa.int64()),
+            ("station_id", pa.int64()),
+            ("name", pa.string()),
+            ("number", pa.int64()),
+            ("lat", pa.float64()),
+            ("lng", pa.float64()),
+            ("free_racks", pa.int32()),
+            ("bikes_available_to_rent", pa.int32()),
+        ]),
+        "bikes": pa.schema([
+            ("timestamp", pa.timestamp("us")),
+            ("city_id", pa.int64()),
+            ("station_id", pa.int64()),
+            ("bike_id", pa.int64()),
+            ("type", pa.int32()),
+            ("active", pa.bool_()),
+            ("state", pa.string()),
+        ]),
+    }
+
+
+def _partitioning():
+    return ds.partitioning(pa.schema([("date", pa.date32()), ("country", pa.string())]), flavor="hive")
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Exporting to Parquet/Arrow requires the pyarrow package.")
+
+
+class ArrowExporter:
+    '''Write fetched data as flat station and bike tables in partitioned Parquet or Arrow IPC files.
+
+    Files are laid out as <folder>/<table>/date=<YYYY-MM-DD>/country=<code>/part-<n>.<parquet|arrow>, so
+    readers can prune partitions and columns. Every write appends the rows of one fetch to an open
+    file per partition. A file is finished when it reaches rows_per_file rows, when the date
+    changes, on the first write after it was open for flush_secs or on close, which the scrapers
+    call when they stop. Unfinished files start with a dot and are ignored by readers. compression
+    only applies to Parquet, Arrow IPC files are written uncompressed so they can be memory mapped
+    without copying, see read_table.'''
+
+    def __init__(self, folder: str = "./export", format: str = "parquet", rows_per_file: int = 1_000_000,
+                 compression: str = "zstd", flush_secs: float = 900):
+        _require_pyarrow()
+        if format not in _formats:
+            raise ValueError(f"Unknown format '{format}'. Choose from {list(_formats)}.")
+        self.folder = folder
+        self.format = format
+        self.rows_per_file = rows_per_file
+        self.compression = compression
+        self.flush_secs = flush_secs
+        self._schemas = _schemas()
+        # (table, date, country) -> [writer, unfinished path, path, rows, opened at]
+        self._writers: dict[tuple[str, date, str], list] = dict()
+
+    def __enter__(self) -> ArrowExporter:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, client: Client, timestamp: Optional[datetime] = None) -> int:
+        '''Append the current stations and bikes of a client. Returns the number of rows written.'''
+        timestamp = timestamp or client.fetched_at or datetime.now()
+        day = timestamp.date()
+        now = time.monotonic()
+        for key in [key for key, entry in self._writers.items() if key[1] != day or now - entry[4] >= self.flush_secs]:
+            self._finish(key)
+
+        rows = 0
+        for table, (columns, countries) in zip(_tables, _flatten(client)):
+            n = len(countries)
+            columns["timestamp"] = pa.array(np.full(n, np.datetime64(timestamp, "us")), pa.timestamp("us"))
+            data = pa.table({name: columns[name] for name in self._schemas[table].names}, schema=self._schemas[table])
+            if n == 0:
+                continue
+            order = np.argsort(countries, kind="stable")
+            sorted_countries = countries[order]
+            bounds = np.flatnonzero(np.r_[True, sorted_countries[1:] != sorted_countries[:-1], True])
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                part = data.take(pa.array(order[start:end]))
+                self._append((table, day, str(sorted_countries[start])), part)
+                rows += part.num_rows
+        return rows
+
+    def flush(self):
+        '''Finish all open files, so that readers see every written row.'''
+        for key in list(self._writers):
+            self._finish(key)
+
+    def close(self):
+        self.flush()
+
+    def _append(self, key: tuple[str, date, str], part: pa.Table):
+        entry = self._writers.get(key)
+        if entry is None:
+            entry = self._writers[key] = self._open(key)
+        entry[0].write_table(part)
+        entry[3] += part.num_rows
+        if entry[3] >= self.rows_per_file:
+            self._finish(key)
+
+    def _open(self, key: tuple[str, date, str]) -> list:
+        table, day, country = key
+        folder = os.path.join(self.folder, table, f"date={day.isoformat()}", f"country={country}")
+        os.makedirs(folder, exist_ok=True)
+        extension = _formats[self.format]
+        parts = [name for name in os.listdir(folder) if name.startswith("part-") and name.endswith(extension)]
+        name = f"part-{len(parts):05d}.{extension}"
+        path, unfinished = os.path.join(folder, name), os.path.join(folder, "." + name)
+        schema = self._schemas[table]
+        if self.format == "parquet":
+            writer = pq.ParquetWriter(unfinished, schema, compression=self.compression)
+        else:
+            writer = pa.ipc.new_file(unfinished, schema)
+        return [writer, unfinished, path, 0, time.monotonic()]
+
+    def _finish(self, key: tuple[str, date, str]):
+        writer, unfinished, path, _, _ = self._writers.pop(key)
+        writer.close()
+        os.replace(unfinished, path)
+
+
+def read_table(folder: str = "./export", table: str = "stations", format: str = "parquet",
+               columns: Optional[list[str]] = None, start: Optional[date] = None, end: Optional[date] = None,
+               countries: Optional[list[str]] = None, filter=None) -> pa.Table:
+    '''Read an exported table, with date and country restored from the partitions.
+
+    Only the given columns and the partitions with start <= date <= end and the given countries
+    are read. filter is an additional pyarrow.dataset expression. Files are memory mapped, so Arrow
+    IPC columns reference the mapped files without copying.'''
+    _require_pyarrow()
+    if table not in _tables:
+        raise ValueError(f"Unknown table '{table}'. Choose from {list(_tables)}.")
+    if format not in _formats:
+        raise ValueError(f"Unknown format '{format}'. Choose from {list(_formats)}.")
+    dataset = ds.dataset(os.path.join(folder, table), format="parquet" if format == "parquet" else "ipc",
+                         partitioning=_partitioning(), filesystem=LocalFileSystem(use_mmap=True))
+    expression = filter
+    for condition in (
+        ds.field("date") >= pa.scalar(start, pa.date32()) if start is not None else None,
+        ds.field("date") <= pa.scalar(end, pa.date32()) if end is not None else None,
+        ds.field("country").isin(countries) if countries is not None else None,
+    ):
+        if condition is not None:
+            expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def _flatten(client: Client) -> tuple[tuple[dict, np.ndarray], tuple[dict, np.ndarray]]:
+    '''Station and bike columns of a client with the country code of every row.'''
+    if client.columns is not None:
+        col = client.columns
+        station_org = col.city_org[col.station_city]
+        station_country = np.array(col.org_country_code, dtype=object)[station_org]
+        stations = {
+            "organization": pa.array(np.array(col.org_name, dtype=object)[station_org], pa.string()),
+            "city_id": col.city_id[col.station_city],
+            "station_id": col.station_id,
+            "name": pa.array(col.station_name, pa.string()),
+            "number": col.station_number,
+            "lat": col.station_lat,
+            "lng": col.station_lng,
+            "free_racks": col.station_free_racks,
+            "bikes_available_to_rent": col.station_bikes_available_to_rent,
+        }
+        bikes = {
+            "city_id": stations["city_id"][col.bike_station],
+            "station_id": col.station_id[col.bike_station],
+            "bike_id": col.bike_id,
+            "type": col.bike_type,
+            "active": col.bike_active.astype(bool),
+            "state": pa.array(np.array(col.states, dtype=object)[col.bike_state], pa.string()),
+        }
+        return (stations, station_country), (bikes, station_country[col.bike_station])
+
+    if client.organizations is None:
+        raise ValueError("No data available. Fetch data first.")
+    s_org, s_city, s_id, s_name, s_number, s_lat, s_lng, s_free, s_bikes, s_country = ([] for _ in range(10))
+    b_city, b_station, b_id, b_type, b_active, b_state, b_country = ([] for _ in range(7))
+    for organization in client.organizations.values():
+        for city in organization.cities.values():
+            for station in city.stations.values():
+                s_org.append(organization.name)
+                s_city.append(city.id)
+                s_id.append(station.id)
+                s_name.append(station.name)
+                s_number.append(station.number)
+                s_lat.append(station.lat)
+                s_lng.append(station.lng)
+                s_free.append(station.free_racks)
+                s_bikes.append(station.bikes_available_to_rent)
+                s_country.append(organization.country_code)
+                for bike in station.bikes.values():
+                    b_city.append(city.id)
+                    b_station.append(station.id)
+                    b_id.append(bike.id)
+                    b_type.append(bike.type)
+                    b_active.append(bike.active)
+                    b_state.append(bike.state)
+                    b_country.append(organization.country_code)
+    stations = {
+        "organization": s_org, "city_id": s_city, "station_id": s_id, "name": s_name, "number": s_number,
+        "lat": s_lat, "lng": s_lng, "free_racks": s_free, "bikes_available_to_rent": s_bikes,
+    }
+    bikes = {
+        "city_id": b_city, "station_id": b_station, "bike_id": b_id, "type": b_type, "active": b_active,
+        "state": b_state,
+    }
+    return (stations, np.array(s_country, dtype=object)), (bikes, np.array(b_country, dtype=object))
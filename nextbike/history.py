@@ -0,0 +1,349 @@
+# Imports
+from __future__ import annotations
+import os
+import json
+import time
+import zlib
+import struct
+import bisect
+from contextlib import ExitStack
+from datetime import datetime
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .utils import log_timestamp_format
+from .nextbike import Country, Organization, City, Station, Bike
+
+__all__ = ["HistoryStore", "HistoryReader", "parse_log_timestamp"]
+
+
+_frame_header = struct.Struct(">IB")
+_codecs = {None: 0, "zlib": 1, "zstd": 2}
+_removed = "~"
+
+
+@dataclass
+class _IndexEntry:
+    timestamp: datetime
+    offset: Optional[int]  # Offset of the block in the segment, None while the block is buffered
+    keyframe: bool
+    position: int = 0  # Position of the record in its block
+
+
+class HistoryStore:
+    '''Append-only history of logged objects with one segment file per entity type.
+
+    Every id starts with a keyframe holding the full object, followed by deltas to the previous
+    state. A new keyframe is written every keyframe_interval records. Records are stored as
+    length prefixed json frames in <folder>/<typ>.seg, one record per frame, or with compression
+    block_size records per zlib or zstd compressed frame. Compressed blocks are buffered until they
+    are full or, on the next append, older than flush_secs. flush or close write them right away,
+    Client.stop_scraping and AsyncClient.scrape do on shutdown. <folder>/<typ>.idx maps the timestamp of
+    each record to the offset of its frame in the segment and its position in the frame.'''
+
+    def __init__(self, folder: str = "./history", keyframe_interval: int = 100, compression: Optional[str] = None,
+                 block_size: int = 256, flush_secs: float = 60):
+        if compression not in _codecs:
+            raise ValueError(f"Unknown compression '{compression}'. Choose from {list(_codecs)}.")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package.")
+        self.folder = folder
+        self.keyframe_interval = keyframe_interval
+        self.compression = compression
+        self.block_size = block_size if compression is not None else 1
+        self.flush_secs = flush_secs
+        self._index: dict[str, dict[str, list[_IndexEntry]]] = dict()
+        self._last: dict[tuple[str, str], tuple[dict, int]] = dict()
+        # typ -> (id, encoded record, entry) of the block not written yet
+        self._pending: dict[str, list[tuple[str, bytes, _IndexEntry]]] = dict()
+        self._pending_since: dict[str, float] = dict()
+        os.makedirs(folder, exist_ok=True)
+
+    def __enter__(self) -> HistoryStore:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ------------------------ writing ----------------------------------------
+    def append(self, typ: str, id: str, timestamp: datetime, data: dict) -> int:
+        '''Append the state of an object at a given time. Returns the number of bytes written to the segment,
+        0 while the block of the record is buffered.'''
+        index = self.index(typ)
+        entries = index.setdefault(id, [])
+        if entries and timestamp < entries[-1].timestamp:
+            raise ValueError(f"Timestamp {timestamp} is older than the last record of {typ}/{id}.")
+        last, since_keyframe = self._last.get((typ, id), (None, 0))
+        keyframe = last is None or since_keyframe + 1 >= self.keyframe_interval
+        record = {"t": timestamp.isoformat(), "id": id, "k": keyframe, "v": data if keyframe else _delta(last, data)}
+
+        pending = self._pending.setdefault(typ, [])
+        since = self._pending_since.setdefault(typ, time.monotonic())
+        entry = _IndexEntry(timestamp, None, keyframe, len(pending))
+        pending.append((id, json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), entry))
+        entries.append(entry)
+        self._last[(typ, id)] = (data, 0 if keyframe else since_keyframe + 1)
+        if len(pending) >= self.block_size or time.monotonic() - since >= self.flush_secs:
+            return self._write_block(typ)
+        return 0
+
+    def flush(self) -> int:
+        '''Write the buffered blocks of all entity types. Returns the number of bytes written.'''
+        return sum(self._write_block(typ) for typ in list(self._pending))
+
+    def close(self):
+        self.flush()
+
+    def _write_block(self, typ: str) -> int:
+        '''Write the buffered records of an entity type as one frame and index them.'''
+        pending = self._pending.pop(typ, [])
+        self._pending_since.pop(typ, None)
+        if not pending:
+            return 0
+        # Json does not contain raw newlines, they separate the records of a block
+        payload = self._compress(b"\n".join(record for _, record, _ in pending))
+        with open(self._path(typ, "seg"), "ab") as f:
+            offset = f.tell()
+            f.write(_frame_header.pack(len(payload), _codecs[self.compression]))
+            f.write(payload)
+        with open(self._path(typ, "idx"), "a", encoding="utf-8") as f:
+            for id, _, entry in pending:
+                entry.offset = offset
+                f.write(f"{entry.timestamp.isoformat()}\t{id}\t{offset}\t{int(entry.keyframe)}\t{entry.position}\n")
+        return _frame_header.size + len(payload)
+
+    # ------------------------ reading ----------------------------------------
+    def ids(self, typ: str) -> list[str]:
+        '''Ids with a stored history of the given entity type.'''
+        return list(self.index(typ))
+
+    def timestamps(self, typ: str, id: str) -> list[datetime]:
+        '''Timestamps of all records of an object.'''
+        return [e.timestamp for e in self.index(typ).get(id, [])]
+
+    def state(self, typ: str, id: str, at: Optional[datetime] = None) -> dict:
+        '''Rebuild the state of an object at a given time. Defaults to the latest state.'''
+        entries = self.index(typ).get(id)
+        if not entries:
+            raise KeyError(f"No history for {typ}/{id}.")
+        end = len(entries) if at is None else bisect.bisect_right([e.timestamp for e in entries], at)
+        if end == 0:
+            raise KeyError(f"No history for {typ}/{id} at {at}.")
+        for _, data in self._replay(typ, entries, end - 1, end):
+            pass
+        return data
+
+    def records(self, typ: str, id: str, start: Optional[datetime] = None,
+                end: Optional[datetime] = None) -> Iterator[tuple[datetime, dict]]:
+        '''Yield (timestamp, state) of an object for all records with start <= timestamp <= end.'''
+        entries = self.index(typ).get(id, [])
+        timestamps = [e.timestamp for e in entries]
+        first = 0 if start is None else bisect.bisect_left(timestamps, start)
+        stop = len(entries) if end is None else bisect.bisect_right(timestamps, end)
+        if first < stop:
+            yield from self._replay(typ, entries, first, stop)
+
+    def _replay(self, typ: str, entries: list[_IndexEntry], first: int, stop: int) -> Iterator[tuple[datetime, dict]]:
+        '''Yield the states of entries[first:stop], starting from the last keyframe before first.'''
+        keyframe = first
+        while not entries[keyframe].keyframe:
+            keyframe -= 1
+        data: dict = dict()
+        pending = self._pending.get(typ, [])
+        block_offset, block = None, []
+        with ExitStack() as stack:
+            f = None  # Opened on the first written record, the segment may not exist yet
+            for i in range(keyframe, stop):
+                entry = entries[i]
+                if entry.offset is None:
+                    record = json.loads(pending[entry.position][1])
+                else:
+                    if entry.offset != block_offset:  # Blocks are decompressed once per replay
+                        if f is None:
+                            f = stack.enter_context(open(self._path(typ, "seg"), "rb"))
+                        f.seek(entry.offset)
+                        block_offset, block = entry.offset, self._read_frame(f).split(b"\n")
+                    record = json.loads(block[entry.position])
+                data = record["v"] if record["k"] else _patch(data, record["v"])
+                if i >= first:
+                    yield entries[i].timestamp, data
+
+    def index(self, typ: str) -> dict[str, list[_IndexEntry]]:
+        '''Index of an entity type: id -> records in timestamp order.'''
+        if typ not in self._index:
+            index: dict[str, list[_IndexEntry]] = dict()
+            path = self._path(typ, "idx")
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        t, id, offset, keyframe, *position = line.rstrip("\n").split("\t")
+                        position = int(position[0]) if position else 0  # Older indices have one record per frame
+                        index.setdefault(id, []).append(
+                            _IndexEntry(datetime.fromisoformat(t), int(offset), keyframe == "1", position))
+            self._index[typ] = index
+        return self._index[typ]
+
+    # ------------------------ frames -----------------------------------------
+    def _path(self, typ: str, ext: str) -> str:
+        return os.path.join(self.folder, f"{typ}.{ext}")
+
+    def _compress(self, payload: bytes) -> bytes:
+        if self.compression == "zlib":
+            return zlib.compress(payload)
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor().compress(payload)
+        return payload
+
+    @staticmethod
+    def _read_frame(f) -> bytes:
+        '''Decompressed payload of the frame at the current position.'''
+        length, codec = _frame_header.unpack(f.read(_frame_header.size))
+        payload = f.read(length)
+        if codec == _codecs["zlib"]:
+            payload = zlib.decompress(payload)
+        elif codec == _codecs["zstd"]:
+            if zstandard is None:
+                raise ValueError("Reading zstd compressed history requires the zstandard package.")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        return payload
+
+
+def _delta(old: dict, new: dict) -> dict:
+    '''Changes from old to new. Nested dicts are diffed recursively, removed keys are listed under "~".'''
+    delta = dict()
+    for k, v in new.items():
+        if k not in old:
+            delta[k] = v
+        elif isinstance(v, dict) and isinstance(old[k], dict):
+            sub = _delta(old[k], v)
+            if sub:
+                delta[k] = sub
+        elif old[k] != v:
+            delta[k] = v
+    removed = [k for k in old if k not in new]
+    if removed:
+        delta[_removed] = removed
+    return delta
+
+
+def _patch(old: dict, delta: dict) -> dict:
+    '''Apply a delta created by _delta without modifying old.'''
+    new = dict(old)
+    for k, v in delta.items():
+        if k == _removed:
+            for removed in v:
+                new.pop(removed, None)
+        elif isinstance(v, dict) and isinstance(new.get(k), dict):
+            new[k] = _patch(new[k], v)
+        else:
+            new[k] = v
+    return new
+
+
+class HistoryReader:
+    '''Time range queries over logged history.
+
+    Reads from the history store if the id is stored there, otherwise from the logfiles
+    <logfolder>/<typ>/<id>/log_<timestamp>.json. The timestamps of each logfile folder are kept in a
+    persistent index under <logfolder>/.index, which is only rebuilt when the folder changed, so a time
+    range is located without listing or opening unrelated files. Objects are loaded lazily.'''
+
+    _index_folder = ".index"
+
+    def __init__(self, logfolder: str = "./logfiles", store: Optional[HistoryStore] = None):
+        self.logfolder = logfolder
+        self.store = store
+        self._indices: dict[str, tuple[int, list[datetime], list[str]]] = dict()
+
+    def country(self, country_code: str, start: Optional[datetime] = None,
+                end: Optional[datetime] = None) -> Iterator[tuple[datetime, Country]]:
+        '''Yield (timestamp, Country) for all logs with start <= timestamp <= end.'''
+        return self._iter(Country, "countries", country_code, start, end)
+
+    def organization(self, organization_name: str, start: Optional[datetime] = None,
+                     end: Optional[datetime] = None) -> Iterator[tuple[datetime, Organization]]:
+        '''Yield (timestamp, Organization) for all logs with start <= timestamp <= end.'''
+        return self._iter(Organization, "organizations", organization_name, start, end)
+
+    def city(self, city_id: int, start: Optional[datetime] = None,
+             end: Optional[datetime] = None) -> Iterator[tuple[datetime, City]]:
+        '''Yield (timestamp, City) for all logs with start <= timestamp <= end.'''
+        return self._iter(City, "cities", city_id, start, end)
+
+    def station(self, station_id: int, start: Optional[datetime] = None,
+                end: Optional[datetime] = None) -> Iterator[tuple[datetime, Station]]:
+        '''Yield (timestamp, Station) for all logs with start <= timestamp <= end.'''
+        return self._iter(Station, "stations", station_id, start, end)
+
+    def bike(self, bike_id: int, start: Optional[datetime] = None,
+             end: Optional[datetime] = None) -> Iterator[tuple[datetime, Bike]]:
+        '''Yield (timestamp, Bike) for all logs with start <= timestamp <= end.'''
+        return self._iter(Bike, "bikes", bike_id, start, end)
+
+    def timestamps(self, typ: str, id: str | int) -> list[datetime]:
+        '''Timestamps of all logs of an object.'''
+        id = str(id)
+        if self._stored(typ, id):
+            return self.store.timestamps(typ, id)
+        return list(self._folder_index(typ, id)[1])
+
+    def files(self, typ: str, id: str | int, start: Optional[datetime] = None,
+              end: Optional[datetime] = None) -> list[tuple[datetime, str]]:
+        '''Logfiles of an object with start <= timestamp <= end, in timestamp order.'''
+        _, timestamps, names = self._folder_index(typ, str(id))
+        first = 0 if start is None else bisect.bisect_left(timestamps, start)
+        stop = len(timestamps) if end is None else bisect.bisect_right(timestamps, end)
+        folder = os.path.join(self.logfolder, typ, str(id))
+        return [(timestamps[i], os.path.join(folder, names[i])) for i in range(first, stop)]
+
+    def _iter(self, cls: type, typ: str, id: str | int, start: Optional[datetime],
+              end: Optional[datetime]) -> Iterator[tuple]:
+        id = str(id)
+        if self._stored(typ, id):
+            for timestamp, data in self.store.records(typ, id, start, end):
+                yield timestamp, cls.from_dict(data)
+            return
+        for timestamp, file in self.files(typ, id, start, end):
+            with open(file, "r", encoding="utf-8") as f:
+                yield timestamp, cls.from_dict(json.load(f))
+
+    def _stored(self, typ: str, id: str) -> bool:
+        return self.store is not None and id in self.store.index(typ)
+
+    def _folder_index(self, typ: str, id: str) -> tuple[int, list[datetime], list[str]]:
+        '''Sorted timestamps and filenames of a logfile folder, cached in memory and on disk.'''
+        folder = os.path.join(self.logfolder, typ, id)
+        if not os.path.isdir(folder):
+            return 0, [], []
+        mtime = os.stat(folder).st_mtime_ns
+        cached = self._indices.get(folder)
+        if cached is not None and cached[0] == mtime:
+            return cached
+
+        index_path = os.path.join(self.logfolder, self._index_folder, typ, f"{id}.txt")
+        names = None
+        if os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            if lines and lines[0] == str(mtime):
+                names = lines[1:]
+        if names is None:
+            names = sorted(name for name in os.listdir(folder) if name.startswith("log_") and name.endswith(".json"))
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            with open(index_path, "w", encoding="utf-8") as f:
+                f.write("\n".join([str(mtime)] + names))
+        timestamps = [parse_log_timestamp(name) for name in names]
+        self._indices[folder] = (mtime, timestamps, names)
+        return self._indices[folder]
+
+
+def parse_log_timestamp(filename: str) -> datetime:
+    '''Timestamp of a logfile named log_<timestamp>.json.'''
+    name = os.path.basename(filename)
+    return datetime.strptime(name[len("log_"):-len(".json")], log_timestamp_format)
+
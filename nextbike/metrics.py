@@ -0,0 +1,180 @@
+# Imports
+from __future__ import annotations
+import time
+import socket
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator, Optional
+
+__all__ = ["Metrics", "StatsdEmitter"]
+
+
+Hook = Callable[[str, str, float, dict], None]  # kind ("counter", "gauge" or "timer"), name, value, labels
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    '''Thread safe counters, gauges and timers of a client.
+
+    Instrumented by the client if set as client.metrics:
+        fetch_requests_total{status}      fetch_failures_total{reason}
+        fetch_bytes_total                 fetch_latency_seconds
+        parse_seconds                     entities{kind}
+        log_writes_total{typ}             log_bytes_total{typ}
+        log_write_seconds{typ}            scrapes_total{result}
+        scrape_lag_seconds
+    Timers are histograms in seconds. Every observation is also passed to the hooks, e.g. a
+    StatsdEmitter. render returns the Prometheus text format and serve exposes it over http.'''
+
+    def __init__(self, prefix: str = "nextbike", buckets: tuple[float, ...] = default_buckets):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.hooks: list[Hook] = []
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, tuple], float] = dict()
+        self._gauges: dict[tuple[str, tuple], float] = dict()
+        # (name, labels) -> [bucket counts, count, sum]
+        self._timers: dict[tuple[str, tuple], list] = dict()
+
+    def add_hook(self, hook: Hook):
+        self.hooks.append(hook)
+
+    # ------------------------ recording --------------------------------------
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._emit("counter", name, value, labels)
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+        self._emit("gauge", name, value, labels)
+
+    def observe(self, name: str, secs: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                timer = self._timers[key] = [[0] * len(self.buckets), 0, 0.0]
+            i = bisect.bisect_left(self.buckets, secs)
+            if i < len(self.buckets):
+                timer[0][i] += 1
+            timer[1] += 1
+            timer[2] += secs
+        self._emit("timer", name, secs, labels)
+
+    @contextmanager
+    def time(self, name: str, **labels) -> Iterator[None]:
+        '''Observe the duration of a block.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _emit(self, kind: str, name: str, value: float, labels: dict):
+        for hook in self.hooks:
+            try:
+                hook(kind, name, value, labels)
+            except Exception as e:
+                print(f"Metrics hook failed: {e}")
+
+    # ------------------------ reading ----------------------------------------
+    def counter(self, name: str, **labels) -> float:
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def gauge(self, name: str, **labels) -> Optional[float]:
+        return self._gauges.get((name, tuple(sorted(labels.items()))))
+
+    def timer(self, name: str, **labels) -> tuple[int, float]:
+        '''Number and sum in seconds of the observations of a timer.'''
+        timer = self._timers.get((name, tuple(sorted(labels.items()))))
+        return (0, 0.0) if timer is None else (timer[1], timer[2])
+
+    def render(self) -> str:
+        '''All metrics in the Prometheus text exposition format.'''
+        with self._lock:
+            counters, gauges = dict(self._counters), dict(self._gauges)
+            timers = {key: (list(t[0]), t[1], t[2]) for key, t in self._timers.items()}
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+                lines.extend(f"{self.prefix}_{n}{_labels(labels)} {value:g}"
+                             for (n, labels), value in sorted(values.items()) if n == name)
+        for name in sorted({name for name, _ in timers}):
+            lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            for (n, labels), (counts, count, total) in sorted(timers.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for le, c in zip(self.buckets, counts):
+                    cumulative += c
+                    lines.append(f"{self.prefix}_{name}_bucket{_labels(labels + (('le', f'{le:g}'),))} {cumulative}")
+                lines.append(f"{self.prefix}_{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.prefix}_{name}_sum{_labels(labels)} {total:g}")
+                lines.append(f"{self.prefix}_{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9464, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        '''Serve render() on http://host:port/metrics in a daemon thread. Returns the server, call shutdown() to stop.'''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class StatsdEmitter:
+    '''Hook sending every observation as a StatsD datagram over UDP.
+
+    Labels are appended in the DogStatsD tag format unless tags is False.'''
+
+    _types = {"counter": "c", "gauge": "g", "timer": "ms"}
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8125, prefix: str = "nextbike", tags: bool = True):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.tags = tags
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, kind: str, name: str, value: float, labels: dict):
+        if kind == "timer":
+            value *= 1000
+        line = f"{self.prefix}.{name}:{value:g}|{self._types[kind]}"
+        if self.tags and labels:
+            line += "|#" + ",".join(f"{k}:{v}" for k, v in sorted(labels.items()))
+        try:
+            self._socket.sendto(line.encode("utf-8"), self.address)
+        except OSError:
+            pass  # Metrics must never break scraping
+
+    def close(self):
+        self._socket.close()
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
@@ -1,14 +1,34 @@
 # Imports
 from __future__ import annotations
 import os
+import sys
 import json
+import time
 import requests
 import threading
-from datetime import datetime
-from dataclasses import dataclass
-from typing import Optional
+from datetime import datetime, timedelta
+from dataclasses import dataclass, field, fields
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional
+from urllib.parse import urlencode, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry, make_headers
 
-from .utils import country_code_map
+from .utils import country_code_map, log_timestamp_format
+from .stream import iter_organizations
+
+if TYPE_CHECKING:
+    from .columnar import ColumnarSnapshot
+    from .diff import Snapshot, SnapshotDiff
+    from .history import HistoryStore, HistoryReader
+    from .metrics import Metrics
+    from .export import ArrowExporter
+    from .cache import SnapshotCache
+    from .replay import FeedArchive, Playback
+    from .alerts import Alert, AlertEngine, Rule
+    from .spatial import SpatialIndex
+
+__all__ = ["Client", "FetchStats", "Country", "Organization", "City", "Station", "Bike"]
 
 
 @dataclass
@@ -20,42 +40,281 @@ class Client:
     bikes: Optional[dict[int, Bike]] = None
     logfolder: str = "./logfiles"
     data: Optional[dict] = None
+    columnar: bool = False
+    columns: Optional[ColumnarSnapshot] = None
+    fetched_at: Optional[datetime] = None
+    store: Optional[HistoryStore] = None
+    timeout: float = 30
+    retries: int = 3
+    fetch_stats: Optional[FetchStats] = None
+    metrics: Optional[Metrics] = None
+    exporter: Optional[ArrowExporter] = None
+    cache: Optional[SnapshotCache] = None
+    recorder: Optional[FeedArchive] = None
+    refresh_fetches: int = 100
     _url: str = "https://api.nextbike.net/maps/nextbike-live.json"
+    _history: Optional[HistoryReader] = field(default=None, init=False, repr=False, compare=False)
+    _session: Optional[requests.Session] = field(default=None, init=False, repr=False, compare=False)
+    _validators: dict[str, tuple] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _fetch_key: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
+    _directory: _Directory = field(default_factory=lambda: _Directory(), init=False, repr=False, compare=False)
+    _raw: dict[str, list[dict]] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _spatial: dict[str, tuple[object, SpatialIndex]] = field(default_factory=dict, init=False, repr=False,
+                                                             compare=False)
+    _scrape_due: Optional[float] = field(default=None, init=False, repr=False, compare=False)
+    _scrape_stop: Optional[threading.Event] = field(default=None, init=False, repr=False, compare=False)
+    _scrape_timer: Optional[threading.Timer] = field(default=None, init=False, repr=False, compare=False)
+    _scrape_lock: threading.RLock = field(default_factory=threading.RLock, init=False, repr=False, compare=False)
+    _alerts: Optional[AlertEngine] = field(default=None, init=False, repr=False, compare=False)
+    # Fetch time and cities of the fetch before the last one, and the changes between them
+    _previous: Optional[tuple[Optional[datetime], dict[int, City]]] = field(default=None, init=False, repr=False,
+                                                                          compare=False)
+    _changes: Optional[SnapshotDiff] = field(default=None, init=False, repr=False, compare=False)
 
     # ------------------------ fetching -----------------------------------------
-    def fetch(self):
-        '''Get the most recent data of the nextbike api.'''
-        res = requests.get(self._url)
-        if not res.ok:
+    def fetch(self, stream: bool = False,
+              country_codes: list[str] = [],
+              organization_names: list[str] = [],
+              city_ids: list[int] = [],
+              station_ids: list[int] = []) -> bool:
+        '''Get the most recent data of the nextbike api. Returns whether fetching succeeded.
+
+        If country codes, organization names, city ids or station ids are given, only the matching
+        organizations and cities are requested and processed. Organizations and countries are
+        requested by their domains once a previous fetch has seen them, so the whole feed is only
+        downloaded if a target cannot be located otherwise. To pick up new organizations of the tracked
+        countries, it is downloaded again every refresh_fetches fetches and whenever a targeted response
+        lacks a tracked country. With stream=True the responses are parsed incrementally, one
+        organization at a time, and the raw data is not kept. With a recorder the raw responses
+        are added to its archive, which requires reading them whole, so stream is ignored.'''
+        stream = stream and self.recorder is None
+        if any(station_id not in self._directory.station_city for station_id in station_ids):
+            # Unknown stations can only be found in the whole feed
+            country_codes, organization_names, city_ids, station_ids = [], [], [], []
+        city_ids = list(city_ids) + [self._directory.station_city[station_id] for station_id in station_ids]
+        tracked = _Tracked(country_codes, organization_names, city_ids)
+        key = (tracked, self.columnar)
+        urls = self._plan_urls(tracked)
+        conditional = key == self._fetch_key and (len(urls) == 1 or urls == list(self._raw))
+
+        if len(urls) == 1:
+            results = [self._get(urls[0], stream, conditional)]
+        else:
+            with ThreadPoolExecutor(min(len(urls), 8)) as pool:
+                results = list(pool.map(lambda url: self._get(url, stream, conditional), urls))
+        if any(res is None for res, _ in results):
+            return False
+        responses = [res for res, _ in results]
+        self.fetch_stats = FetchStats.combine([stats for _, stats in results])
+        self._directory.targeted = 0 if urls[0] == self._url else self._directory.targeted + 1
+        self._previous = (self.fetched_at, self.cities if self.cities is not None else dict())
+        self._changes = None
+        replayed = responses[0].headers.get("X-Replay-Time")  # Recorded time of a replayed response
+        self.fetched_at = datetime.fromisoformat(replayed) if replayed else datetime.now()
+        if all(res.status_code == 304 for res in responses):  # Unchanged since the last fetch
+            self._record_fetch(parsed=False)
+            self._record_responses(urls, responses)
+            if self._alerts is not None:
+                self._alerts.check(self.fetched_at)
+            return True
+
+        parse_start = time.perf_counter()
+        if len(urls) == 1:
+            self._raw = dict()
+            res = responses[0]
+            whole_feed = urls[0] == self._url
+            if stream:
+                self.data = None
+                res.raw.decode_content = True
+                self._process_organizations(self._directory.learn(iter_organizations(res.raw), whole_feed),
+                                            tracked)
+            else:
+                self.data = res.json()
+                self._process_organizations(self._directory.learn(self.data["countries"], whole_feed), tracked)
+        else:
+            # Targeted responses are small, they are kept to merge unchanged ones into later fetches
+            raw = dict()
+            for url, res in zip(urls, responses):
+                if res.status_code == 304:
+                    raw[url] = self._raw[url]
+                elif stream:
+                    res.raw.decode_content = True
+                    raw[url] = list(iter_organizations(res.raw))
+                else:
+                    raw[url] = res.json()["countries"]
+            self._raw = raw
+            organizations = _merge_organizations(o for orgs in raw.values() for o in orgs)
+            self.data = None if stream else {"countries": organizations}
+            self._process_organizations(self._directory.learn(organizations, False), tracked)
+        if urls[0] != self._url:
+            for country_code in tracked.country_codes:
+                if country_code not in self._directory.seen_countries:  # Known domains went stale, look them up again
+                    self._directory.country_domains.pop(country_code, None)
+        self.fetch_stats.parse_secs = time.perf_counter() - parse_start
+        self.fetch_stats.bytes_transferred = sum(res.raw.tell() for res in responses)
+        self._record_fetch()
+        if self.cache is not None:
+            self.cache.add(self.fetched_at, self)
+        self._fetch_key = key
+        for url, res in zip(urls, responses):
+            if res.status_code != 304:
+                self._validators[url] = (res.headers.get("ETag"), res.headers.get("Last-Modified"))
+        self._record_responses(urls, responses)
+        if self._alerts is not None:
+            if self.columns is None and self._previous[1]:  # Diffs do not report added cities, seed first
+                self._alerts.apply(self.changes())
+            else:
+                self._alerts.update(self.snapshot(bikes=False))
+        return True
+
+    def _plan_urls(self, tracked: _Tracked) -> list[str]:
+        '''Smallest set of feed urls covering the tracked organizations and cities.
+
+        Countries and organizations are requested by domain, remaining cities by id. Falls back to
+        the whole feed if nothing is tracked, an organization has not been seen yet or the domains of a
+        country are not known from a download of the whole feed within the last refresh_fetches fetches.'''
+        if tracked.everything:
+            return [self._url]
+        domains = set()
+        for country_code in tracked.country_codes:
+            if country_code not in self._directory.country_domains or \
+                    self._directory.targeted >= self.refresh_fetches:
+                return [self._url]
+            domains.update(self._directory.country_domains[country_code])
+        for organization_name in tracked.organization_names:
+            if organization_name not in self._directory.org_domain:
+                return [self._url]
+            domains.add(self._directory.org_domain[organization_name])
+        urls = [f"{self._url}?{urlencode({'domains': ','.join(sorted(domains))})}"] if domains else []
+        for city_id in sorted(set(tracked.city_ids)):
+            if self._directory.city_domain.get(city_id) not in domains:
+                urls.append(f"{self._url}?{urlencode({'city': city_id})}")
+        return urls
+
+    def _get(self, url: str, stream: bool,
+             conditional: bool = False) -> tuple[Optional[requests.Response], Optional[FetchStats]]:
+        '''GET a feed url on the pooled session. Returns the response, None on failure, and its statistics.
+
+        A conditional request sends the ETag/Last-Modified validators of the last processed response
+        of this url, so an unchanged feed is answered with 304 Not Modified and no body. It must only
+        be used if the current data was built from that response the same way.'''
+        session = self._pooled_session()
+        headers = make_headers(accept_encoding=True)
+        validator = self._validators.get(url)
+        if conditional and validator is not None:
+            etag, last_modified = validator
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        start = time.perf_counter()
+        try:
+            res = session.get(url, headers=headers, stream=stream, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"Fetching failed. API not reachable: {e}")
+            if self.metrics is not None:
+                self.metrics.inc("fetch_failures_total", reason="connection")
+            return None, None
+        latency = time.perf_counter() - start
+        if self.metrics is not None:
+            self.metrics.inc("fetch_requests_total", status=res.status_code)
+            self.metrics.observe("fetch_latency_seconds", latency)
+        if res.status_code != 304 and not res.ok:
             print("Fetching failed. API not reachable.")
-            return
+            if self.metrics is not None:
+                self.metrics.inc("fetch_failures_total", reason="status")
+            return None, None
         res.encoding = "utf-8"
-        self.data = res.json()
-        self._process_raw_data()
+        return res, FetchStats(url, res.status_code, res.status_code == 304, res.raw.tell(),
+                               None if stream else len(res.content), latency)
+
+    def _record_responses(self, urls: list[str], responses: list[requests.Response]):
+        '''Add the responses of the last fetch to the archive of the recorder. Unchanged ones repeat the previous body.'''
+        if self.recorder is None:
+            return
+        for url, res in zip(urls, responses):
+            self.recorder.append(self.fetched_at, urlsplit(url).query, None if res.status_code == 304 else res.content)
+
+    def _pooled_session(self) -> requests.Session:
+        if self._session is None:
+            self._session = requests.Session()
+            retry = Retry(total=self.retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+            self._session.mount("https://", HTTPAdapter(max_retries=retry))
+            self._session.mount("http://", HTTPAdapter(max_retries=retry))
+        return self._session
+
+    def replay(self, archive: FeedArchive, speed: Optional[float] = None, loop: bool = False) -> Playback:
+        '''Fetch from a feed archive instead of the api. Returns the playback deciding the current responses.
+
+        Without a speed, every playback.step() moves to the next recorded fetch. With a speed, the
+        recording is replayed that many times faster than real time. fetched_at is the recorded time.'''
+        from .replay import Playback, ReplayAdapter
 
-    def _process_raw_data(self):
+        playback = Playback(archive, speed, loop)
+        self._pooled_session().mount(self._url, ReplayAdapter(playback))
+        self._validators.clear()
+        self._fetch_key = None
+        return playback
+
+    def _record_fetch(self, parsed: bool = True):
+        '''Pass the statistics of the last fetch and the entity counts to the metrics.'''
+        if self.metrics is None:
+            return
+        self.metrics.inc("fetch_bytes_total", self.fetch_stats.bytes_transferred)
+        if not parsed:
+            return
+        self.metrics.observe("parse_seconds", self.fetch_stats.parse_secs)
+        if self.columns is not None:
+            counts = {"organizations": len(self.columns.org_name), "cities": len(self.columns.city_id),
+                      "stations": len(self.columns.station_id), "bikes": len(self.columns.bike_id)}
+        else:
+            counts = {"countries": len(self.countries), "organizations": len(self.organizations),
+                      "cities": len(self.cities), "stations": len(self.stations), "bikes": len(self.bikes)}
+        for kind, count in counts.items():
+            self.metrics.set("entities", count, kind=kind)
+
+    def _process_raw_data(self, tracked: Optional[_Tracked] = None):
         '''Processes json formatted data into a data structure.'''
         if self.data is None:
             raise ValueError("No data to process. Fetch data first.")
+        self._process_organizations(self.data["countries"], tracked)
 
+    def _process_organizations(self, organizations: Iterable[dict], tracked: Optional[_Tracked] = None):
+        '''Builds the data structure from json formatted organizations, skipping untracked ones.'''
+        if self.columnar:
+            self._build_columns(organizations, tracked)
+        else:
+            self._build_tree(organizations, tracked)
+
+    def _build_tree(self, organizations: Iterable[dict], tracked: Optional[_Tracked] = None):
+        '''Builds the Country/Organization/City/Station/Bike tree.
+
+        Unchanged cities, stations and bikes of the previous tree are reused instead of rebuilt, so
+        consecutive fetches, e.g. in a snapshot cache, share them. Repeated strings are interned with sys.intern, which frees them once unused.'''
+        previous_cities = self.cities if self.cities is not None else dict()
+        self.columns = None
         self.organizations = dict()
         self.countries = dict()
         self.cities = dict()
         self.stations = dict()
         self.bikes = dict()
-        for organization in self.data["countries"]:
-            organization_name = organization["name"]
-            country_name = organization["country_name"]
-            country_code = organization["country"].lower()
+        for organization, tracked_cities in _iter_tracked(organizations, tracked):
+            organization_name = sys.intern(organization["name"])
+            country_name = sys.intern(organization["country_name"])
+            country_code = sys.intern(organization["country"].lower())
             org_lat = float(organization["lat"])
             org_lng = float(organization["lng"])
             cities = dict()
-            for city in organization["cities"]:
+            for city in tracked_cities:
                 city_id = int(city["uid"])
-                city_name = city["name"]
+                city_name = sys.intern(city["name"])
                 available_bikes = city["available_bikes"]
                 city_lat = float(city["lat"])
                 city_lng = float(city["lng"])
+                previous_city = previous_cities.get(city_id)
+                previous_stations = previous_city.stations if previous_city is not None else dict()
+                stations_changed = previous_city is None or len(previous_stations) != len(city["places"])
                 stations = dict()
                 for station in city["places"]:
                     station_id = int(station["uid"])
@@ -65,19 +324,40 @@ class Client:
                     bikes_available_to_rent = station["bikes_available_to_rent"]
                     station_lat = float(station["lat"])
                     station_lng = float(station["lng"])
+                    previous_station = previous_stations.get(station_id)
+                    previous_bikes = previous_station.bikes if previous_station is not None else dict()
+                    bikes_changed = previous_station is None or len(previous_bikes) != len(station["bike_list"])
                     bikes = dict()
                     for bike in station["bike_list"]:
                         bike_id = int(bike["number"])
                         bike_type = int(bike["bike_type"])
                         active = bike["active"]
-                        state = bike["state"]
-                        bikes[bike_id] = Bike(bike_id, bike_type, active, state, station_lat, station_lng)
-                        self.bikes[bike_id] = Bike(bike_id, bike_type, active, state, station_lat, station_lng)
-                    station = Station(station_id, station_name, station_number, station_lat,
-                                      station_lng, free_racks, bikes_available_to_rent, bikes)
+                        state = sys.intern(bike["state"])
+                        shared = previous_bikes.get(bike_id)
+                        if shared is None or (shared.type, shared.active, shared.state, shared.lat, shared.lng) != \
+                                (bike_type, active, state, station_lat, station_lng):
+                            shared = Bike(bike_id, bike_type, active, state, station_lat, station_lng)
+                            bikes_changed = True
+                        bikes[bike_id] = shared
+                        self.bikes[bike_id] = shared
+                    if bikes_changed or (previous_station.name, previous_station.number, previous_station.lat,
+                                         previous_station.lng, previous_station.free_racks,
+                                         previous_station.bikes_available_to_rent) != \
+                            (station_name, station_number, station_lat, station_lng, free_racks,
+                             bikes_available_to_rent):
+                        station = Station(station_id, station_name, station_number, station_lat,
+                                          station_lng, free_racks, bikes_available_to_rent, bikes)
+                        stations_changed = True
+                    else:
+                        station = previous_station
                     stations[station_id] = station
                     self.stations[station_id] = station
-                city = City(city_id, city_name, city_lat, city_lng, available_bikes, stations)
+                if stations_changed or (previous_city.name, previous_city.lat, previous_city.lng,
+                                        previous_city.available_bikes) != \
+                        (city_name, city_lat, city_lng, available_bikes):
+                    city = City(city_id, city_name, city_lat, city_lng, available_bikes, stations)
+                else:
+                    city = previous_city
                 cities[city_id] = city
                 self.cities[city_id] = city
                 if country_code not in self.countries.keys():
@@ -87,6 +367,120 @@ class Client:
             self.organizations[organization_name] = Organization(
                 organization_name, country_name, country_code, org_lat, org_lng, cities)
 
+    def _build_columns(self, organizations: Iterable[dict], tracked: Optional[_Tracked] = None):
+        '''Builds a ColumnarSnapshot instead of the object tree.'''
+        from .columnar import ColumnarBuilder
+
+        self.organizations = None
+        self.countries = None
+        self.cities = None
+        self.stations = None
+        self.bikes = None
+        builder = ColumnarBuilder()
+        for organization, tracked_cities in _iter_tracked(organizations, tracked):
+            builder.add_organization(organization["name"], organization["country_name"],
+                                     organization["country"].lower(),
+                                     float(organization["lat"]), float(organization["lng"]))
+            for city in tracked_cities:
+                builder.add_city(int(city["uid"]), city["name"], float(city["lat"]), float(city["lng"]),
+                                 int(city["available_bikes"]))
+                for station in city["places"]:
+                    builder.add_station(int(station["uid"]), station["name"], int(station["number"]),
+                                        float(station["lat"]), float(station["lng"]), int(station["free_racks"]),
+                                        int(station["bikes_available_to_rent"]))
+                    for bike in station["bike_list"]:
+                        builder.add_bike(int(bike["number"]), int(bike["bike_type"]), bike["active"], bike["state"])
+        self.columns = builder.build()
+
+    # ------------------------ diffing -----------------------------------------
+    def snapshot(self, bikes: bool = True) -> Snapshot:
+        '''Take a compact snapshot of the current data to diff against later.'''
+        from .diff import Snapshot
+
+        return Snapshot.from_client(self, bikes=bikes)
+
+    def diff(self, previous: Snapshot) -> SnapshotDiff:
+        '''Get the changes of the current data compared to a previous snapshot.'''
+        from .diff import diff
+
+        return diff(previous, self.snapshot())
+
+    def changes(self) -> SnapshotDiff:
+        '''Changes of the last fetch compared to the fetch before, everything added after the first one.
+
+        Computed once per fetch from the unchanged objects shared between the two fetches, so it does not
+        scan every bike like diff does. Not available for columnar clients, diff their snapshots instead.'''
+        from .diff import diff_trees
+
+        if self.columnar:
+            raise ValueError("Changes are only tracked for the object tree. Use snapshot() and diff() instead.")
+        if self._previous is None:
+            raise ValueError("No data available. Fetch data first.")
+        if self._changes is None:
+            previous_time, previous_cities = self._previous
+            self._changes = diff_trees(previous_cities, self.cities, previous_time or self.fetched_at,
+                                       self.fetched_at)
+        return self._changes
+
+    # ------------------------ alerts -----------------------------------------
+    def subscribe(self, condition: Callable, callback: Callable[[Alert], None], kind: str = "stations",
+                  ids: Optional[Iterable[int]] = None, for_duration: timedelta = timedelta(0),
+                  on_resolve: Optional[Callable[[Alert], None]] = None, name: str = "") -> Rule:
+        '''Call callback after every fetch in which condition starts to hold for a station or city.
+
+        condition gets a StationState or CityState of the watched "stations" or "cities", all of them
+        if ids is None, and has to hold for for_duration before the rule fires. Only the rules of
+        changed stations and cities are evaluated, see AlertEngine. Returns the rule to unsubscribe.'''
+        from .alerts import AlertEngine, Rule
+
+        if self._alerts is None:
+            self._alerts = AlertEngine()
+            if self.fetched_at is not None and (self.cities is not None or self.columns is not None):
+                self._alerts.update(self.snapshot(bikes=False))
+        return self._alerts.add(Rule(kind, condition, callback, None if ids is None else frozenset(ids),
+                                     for_duration, on_resolve, name))
+
+    def unsubscribe(self, rule: Rule):
+        if self._alerts is not None:
+            self._alerts.remove(rule)
+
+    # ------------------------ cache ------------------------------------------
+    def at(self, timestamp: datetime) -> Client:
+        '''The cached data of the latest fetch not after a time, as a client. Requires a snapshot cache.'''
+        if self.cache is None:
+            raise ValueError("No snapshot cache. Create the client with a SnapshotCache.")
+        return self.cache.at(timestamp)
+
+    def window(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> list[tuple[datetime, Client]]:
+        '''(timestamp, client) pairs of the cached fetches with start <= timestamp <= end. Requires a snapshot cache.'''
+        if self.cache is None:
+            raise ValueError("No snapshot cache. Create the client with a SnapshotCache.")
+        return self.cache.window(start, end)
+
+    # ------------------------ spatial ------------------------------------------
+    def spatial_index(self, kind: str = "stations", cell_deg: float = 0.01) -> SpatialIndex:
+        '''Spatial index over the positions of all "stations" or "bikes", built once per fetch.'''
+        from .spatial import SpatialIndex
+
+        if kind not in ("stations", "bikes"):
+            raise ValueError(f"Unknown kind '{kind}'. Choose from 'stations' or 'bikes'.")
+        source = self.columns if self.columns is not None else getattr(self, kind)
+        if source is None:
+            raise ValueError("No data available. Fetch data first.")
+        cached = self._spatial.get(kind)
+        if cached is not None and cached[0] is source and cached[1].cell_deg == cell_deg:
+            return cached[1]
+
+        if self.columns is None:
+            index = SpatialIndex._from_objects(list(source.values()), cell_deg)
+        elif kind == "stations":
+            index = SpatialIndex(source.station_id, source.station_lat, source.station_lng, source.station, cell_deg)
+        else:
+            index = SpatialIndex(source.bike_id, source.station_lat[source.bike_station],
+                                 source.station_lng[source.bike_station], source.bike, cell_deg)
+        self._spatial[kind] = (source, index)
+        return index
+
     # ------------------------ scraping -----------------------------------------
     def scrape(self, interval_secs: int,
                country_codes: list[str] = [],
@@ -94,8 +488,64 @@ class Client:
                city_ids: list[int] = [],
                station_ids: list[int] = [],
                bike_ids: list[int] = [],
-               scrape_count: int = 0):
-        self.fetch()
+               scrape_count: int = 0,
+               stream: bool = False):
+        '''Scrape every interval_secs in the background until stop_scraping is called.'''
+        self.stop_scraping()
+        self._scrape_stop = threading.Event()
+        self._scrape(self._scrape_stop, interval_secs, (country_codes, organization_names, city_ids, station_ids,
+                                                        bike_ids), scrape_count, stream)
+
+    def stop_scraping(self):
+        '''Stop scraping after the running scrape and write the buffered history and exported data.'''
+        if self._scrape_stop is not None:
+            self._scrape_stop.set()
+        if self._scrape_timer is not None:
+            self._scrape_timer.cancel()
+        with self._scrape_lock:  # Waits for a running scrape
+            self._scrape_stop = self._scrape_timer = None
+            self.flush()
+
+    def flush(self):
+        '''Write the buffered blocks of the history store and finish the open files of the exporter.'''
+        if self.store is not None:
+            self.store.flush()
+        if self.exporter is not None:
+            self.exporter.close()
+
+    def _scrape(self, stop: threading.Event, interval_secs: int, targets: tuple, scrape_count: int, stream: bool):
+        with self._scrape_lock:
+            if stop.is_set():
+                return
+            if self.metrics is not None and self._scrape_due is not None:
+                self.metrics.observe("scrape_lag_seconds", max(0.0, time.monotonic() - self._scrape_due))
+            if self._scrape_tick(*targets, stream):
+                scrape_count += 1
+            print(100 * " ", end="\r")
+            print(f"\rScraped: {scrape_count}", end="")
+
+            self._scrape_due = time.monotonic() + interval_secs
+            self._scrape_timer = threading.Timer(interval_secs, self._scrape,
+                                                 args=[stop, interval_secs, targets, scrape_count, stream])
+            self._scrape_timer.start()
+
+    def _scrape_tick(self, country_codes: list[str], organization_names: list[str], city_ids: list[int],
+                     station_ids: list[int], bike_ids: list[int], stream: bool = False) -> bool:
+        '''Fetch and log the given targets once. Returns whether fetching succeeded.'''
+        if bike_ids:
+            ok = self.fetch(stream)
+        else:  # Only the tracked subtrees are needed
+            ok = self.fetch(stream, country_codes, organization_names, city_ids, station_ids)
+        if ok:
+            self._log_targets(country_codes, organization_names, city_ids, station_ids, bike_ids)
+            if self.exporter is not None:
+                self.exporter.write(self)
+        if self.metrics is not None:
+            self.metrics.inc("scrapes_total", result="ok" if ok else "failed")
+        return ok
+
+    def _log_targets(self, country_codes: list[str], organization_names: list[str], city_ids: list[int],
+                     station_ids: list[int], bike_ids: list[int]):
         for country_code in country_codes:
             self.log_country(country_code)
         for organization_name in organization_names:
@@ -106,13 +556,6 @@ class Client:
             self.log_station(station_id)
         for bike_id in bike_ids:
             self.log_bike(bike_id)
-        scrape_count += 1
-        print(100 * " ", end="\r")
-        print(f"\rScraped: {scrape_count}", end="")
-
-        threading.Timer(interval_secs, self.scrape, args=[
-                        interval_secs, country_codes, organization_names, city_ids, station_ids, bike_ids, scrape_count]
-                        ).start()
 
     # ------------------------ logging -----------------------------------------
     def log_country(self, country_code: str):
@@ -151,145 +594,302 @@ class Client:
         self._log(bike, typ, id)
 
     def _log(self, obj: Country | Organization | City | Station | Bike, typ: str, id: str):
-        timestamp = datetime.now().strftime("%Y_%m_%d__%H_%M_%S")
-        folder = os.path.join(self.logfolder, typ, id)
-        os.makedirs(folder, exist_ok=True)
+        start = time.perf_counter()
+        if self.store is not None:
+            size = self.store.append(typ, id, self.fetched_at or datetime.now(), _serialize(obj))
+        else:
+            timestamp = (self.fetched_at or datetime.now()).strftime(log_timestamp_format)
+            folder = os.path.join(self.logfolder, typ, id)
+            os.makedirs(folder, exist_ok=True)
 
-        file = os.path.join(folder, f"log_{timestamp}.json")
-        with open(file, "w", encoding="utf-8") as f:
-            json.dump(obj, f, default=lambda o: o.__dict__, ensure_ascii=False, sort_keys=True, indent=4)
+            file = os.path.join(folder, f"log_{timestamp}.json")
+            with open(file, "w", encoding="utf-8") as f:
+                json.dump(obj, f, default=_to_json_dict, ensure_ascii=False, sort_keys=True, indent=4)
+                size = f.tell()
+        if self.metrics is not None:
+            self.metrics.inc("log_writes_total", typ=typ)
+            self.metrics.inc("log_bytes_total", size, typ=typ)
+            self.metrics.observe("log_write_seconds", time.perf_counter() - start, typ=typ)
 
     # ------------------------ loading ----------------------------------------
-    def load_country(self, file: str) -> Country:
-        '''Load a Country from a stored File'''
-        country_data = self._load_dict(file)
-        country = Country(country_data['name'], country_data['code'], country_data["lat"], country_data["lng"], {})
-        for city_id, city_data in country_data['cities'].items():
-            city_id = int(city_id)
-            city = City(city_id, city_data['name'], city_data['lat'], city_data['lng'],
-                        city_data['available_bikes'], {})
-            for station_id, station_data in city_data['stations'].items():
-                station_id = int(station_id)
-                station = Station(station_id, station_data['name'], station_data['number'],
-                                  station_data['lat'], station_data['lng'], station_data['free_racks'],
-                                  station_data['bikes_available_to_rent'], {})
-                for bike_id, bike_data in station_data['bikes'].items():
-                    bike_id = int(bike_id)
-                    bike = Bike(bike_id, bike_data['type'], bike_data['active'],
-                                bike_data['state'], bike_data["lat"], bike_data["lng"])
-                    station.bikes[bike_id] = bike
-                city.stations[station_id] = station
-            country.cities[city_id] = city
-        return country
+    def load_country(self, file: Optional[str] = None,
+                     country_code: Optional[str] = None, at: Optional[datetime] = None) -> Country:
+        '''Load a Country from a stored File or from the history store at a given time'''
+        return Country.from_dict(self._load_dict(file, "countries", country_code, at))
 
-    def load_organization(self, file: str) -> Organization:
-        '''Load an organization from a stored File'''
-        org_data = self._load_dict(file)
-        organization = Organization(org_data['name'], org_data['country_name'], org_data['country_code'],
-                                    org_data['lat'], org_data['lng'], {})
-        for city_id, city_data in org_data['cities'].items():
-            city_id = int(city_id)
-            city = City(city_id, city_data['name'], city_data['lat'], city_data['lng'],
-                        city_data['available_bikes'], {})
-            for station_id, station_data in city_data['stations'].items():
-                station_id = int(station_id)
-                station = Station(station_id, station_data['name'], station_data['number'],
-                                  station_data['lat'], station_data['lng'], station_data['free_racks'],
-                                  station_data['bikes_available_to_rent'], {})
-                for bike_id, bike_data in station_data['bikes'].items():
-                    bike_id = int(bike_id)
-                    bike = Bike(bike_id, bike_data['type'], bike_data['active'],
-                                bike_data['state'], bike_data["lat"], bike_data["lng"])
-                    station.bikes[bike_id] = bike
-                city.stations[station_id] = station
-            organization.cities[city_id] = city
-        return organization
+    def load_organization(self, file: Optional[str] = None,
+                          organization_name: Optional[str] = None, at: Optional[datetime] = None) -> Organization:
+        '''Load an organization from a stored File or from the history store at a given time'''
+        return Organization.from_dict(self._load_dict(file, "organizations", organization_name, at))
+
+    def load_city(self, file: Optional[str] = None,
+                  city_id: Optional[int] = None, at: Optional[datetime] = None) -> City:
+        '''Load a city from a stored File or from the history store at a given time'''
+        return City.from_dict(self._load_dict(file, "cities", city_id, at))
+
+    def load_station(self, file: Optional[str] = None,
+                     station_id: Optional[int] = None, at: Optional[datetime] = None) -> Station:
+        '''Load a station from a stored File or from the history store at a given time'''
+        return Station.from_dict(self._load_dict(file, "stations", station_id, at))
 
-    def load_city(self, file: str) -> City:
-        '''Load a city from a stored File'''
-        city_data = self._load_dict(file)
-        city = City(city_data['id'], city_data['name'], city_data['lat'], city_data['lng'],
-                    city_data['available_bikes'], {})
-        for station_id, station_data in city_data['stations'].items():
-            station_id = int(station_id)
-            station = Station(station_id, station_data['name'], station_data['number'],
-                              station_data['lat'], station_data['lng'], station_data['free_racks'],
-                              station_data['bikes_available_to_rent'], {})
-            for bike_id, bike_data in station_data['bikes'].items():
-                bike_id = int(bike_id)
-                bike = Bike(bike_id, bike_data['type'], bike_data['active'],
-                            bike_data['state'], bike_data["lat"], bike_data["lng"])
-                station.bikes[bike_id] = bike
-            city.stations[station_id] = station
-        return city
-
-    def load_station(self, file: str) -> Station:
-        '''Load a station from a stored File'''
-        station_data = self._load_dict(file)
-        station = Station(station_data['id'], station_data['name'], station_data['number'],
-                          station_data['lat'], station_data['lng'], station_data['free_racks'],
-                          station_data['bikes_available_to_rent'], {})
-        for bike_id, bike_data in station_data['bikes'].items():
-            bike_id = int(bike_id)
-            bike = Bike(bike_id, bike_data['type'], bike_data['active'],
-                        bike_data['state'], bike_data["lat"], bike_data["lng"])
-            station.bikes[bike_id] = bike
-        return station
-
-    def load_bike(self, file: str) -> Bike:
-        '''Load a bike from a stored File'''
-        bike_data = self._load_dict(file)
-        bike = Bike(bike_data['id'], bike_data['type'], bike_data['active'],
-                    bike_data['state'], bike_data["lat"], bike_data["lng"])
-        return bike
-
-    def _load_dict(self, file: str):
-        '''Load the logfile and converts to a dictionary.'''
+    def load_bike(self, file: Optional[str] = None,
+                  bike_id: Optional[int] = None, at: Optional[datetime] = None) -> Bike:
+        '''Load a bike from a stored File or from the history store at a given time'''
+        return Bike.from_dict(self._load_dict(file, "bikes", bike_id, at))
+
+    def load_many(self, paths: str | Iterable[str], kind: str = "city",
+                  workers: Optional[int] = None) -> list[tuple[datetime, Country | Organization | City | Station | Bike]]:
+        '''Load many logfiles of one kind in parallel, see nextbike.bulk.load_many'''
+        from .bulk import load_many
+
+        return load_many(paths, kind, workers)
+
+    def _load_dict(self, file: Optional[str], typ: str = "", id: Optional[str | int] = None,
+                   at: Optional[datetime] = None) -> dict:
+        '''Load the logfile, or the state of the given id from the history store, as a dictionary.'''
+        if file is None:
+            if self.store is None or id is None:
+                raise ValueError("Either a file or an id and a history store are required.")
+            return self.store.state(typ, str(id), at)
         if not os.path.exists(file):
-            print("File at path {filename} not found. Skipping.")
+            print(f"File at path {file} not found. Skipping.")
         with open(file, "r", encoding="utf-8") as f:
             d = json.load(f)
         return d
 
+    @property
+    def history(self) -> HistoryReader:
+        '''Time range queries over the logged history, e.g. client.history.station(id, start, end).'''
+        from .history import HistoryReader
+
+        if self._history is None or self._history.logfolder != self.logfolder or self._history.store is not self.store:
+            self._history = HistoryReader(self.logfolder, self.store)
+        return self._history
+
     # ------------------------ methods ----------------------------------------
     def get_organization(self, organization_name: str) -> Organization:
         '''Get data of a specific organization.'''
+        if self.columns is not None:
+            return self.columns.organization(organization_name)
         if self.organizations is None:
             raise ValueError("No data available. Fetch data first.")
         return self.organizations[organization_name]
 
     def get_country(self, country_code: str) -> Country:
         '''Get data of a specific country.'''
+        if self.columns is not None:
+            return self.columns.country(country_code)
         if self.countries is None:
             raise ValueError("No data available. Fetch data first.")
         return self.countries[country_code]
 
     def get_city(self, city_id: int) -> City:
         '''Get data of a specific city.'''
+        if self.columns is not None:
+            return self.columns.city(city_id)
         if self.cities is None:
             raise ValueError("No data available. Fetch data first.")
         return self.cities[city_id]
 
     def get_station(self, station_id: int) -> Station:
         '''Get data of a specific station.'''
+        if self.columns is not None:
+            return self.columns.station(station_id)
         if self.stations is None:
             raise ValueError("No data available. Fetch data first.")
         return self.stations[station_id]
 
     def get_bike(self, bike_id: int) -> Bike:
         '''Get data of a specific station.'''
+        if self.columns is not None:
+            return self.columns.bike(bike_id)
         if self.bikes is None:
             raise ValueError("No data available. Fetch data first.")
         return self.bikes[bike_id]
 
 
+def _iter_tracked(organizations: Iterable[dict], tracked: Optional[_Tracked]) -> Iterator[tuple[dict, list[dict]]]:
+    '''Yield the tracked organizations together with their tracked cities.'''
+    for organization in organizations:
+        if tracked is None:
+            yield organization, organization["cities"]
+            continue
+        organization_name = organization["name"]
+        country_code = organization["country"].lower()
+        if tracked.organization(organization_name, country_code):
+            yield organization, organization["cities"]
+            continue
+        cities = [city for city in organization["cities"] if int(city["uid"]) in tracked.city_ids]
+        if cities:
+            yield organization, cities
+
+
 @dataclass
-class Country:
+class FetchStats:
+    '''Transfer statistics of the last fetch.'''
+    url: str
+    status: int
+    not_modified: bool
+    bytes_transferred: int
+    bytes_decoded: Optional[int]
+    latency_secs: float
+    parse_secs: float = 0
+
+    def __str__(self) -> str:
+        return "FetchStats:\n" + \
+            f"\tURL               : {self.url}\n" + \
+            f"\tStatus            : {self.status}\n" + \
+            f"\tNot modified      : {self.not_modified}\n" + \
+            f"\tBytes transferred : {self.bytes_transferred}\n" + \
+            f"\tBytes decoded     : {self.bytes_decoded}\n" + \
+            f"\tLatency           : {self.latency_secs:.3f}s\n" + \
+            f"\tParse time        : {self.parse_secs:.3f}s"
+
+    @classmethod
+    def combine(cls, stats: list[FetchStats]) -> FetchStats:
+        '''Combine the statistics of concurrent requests.'''
+        if len(stats) == 1:
+            return stats[0]
+        decoded = [s.bytes_decoded for s in stats]
+        return cls(", ".join(s.url for s in stats), max(s.status for s in stats), all(s.not_modified for s in stats),
+                   sum(s.bytes_transferred for s in stats), None if None in decoded else sum(decoded),
+                   max(s.latency_secs for s in stats))
+
+
+def _merge_organizations(organizations: Iterable[dict]) -> list[dict]:
+    '''Merge organizations returned by several queries, joining the cities of duplicates.'''
+    merged = dict()
+    for organization in organizations:
+        name = organization["name"]
+        if name not in merged:
+            merged[name] = dict(organization, cities=list(organization["cities"]))
+            continue
+        known = {city["uid"] for city in merged[name]["cities"]}
+        merged[name]["cities"].extend(city for city in organization["cities"] if city["uid"] not in known)
+    return list(merged.values())
+
+
+@dataclass
+class _Directory:
+    '''Where organizations, cities and stations were found in previous fetches.'''
+    org_domain: dict[str, str] = field(default_factory=dict)
+    country_domains: dict[str, set[str]] = field(default_factory=dict)
+    city_domain: dict[int, str] = field(default_factory=dict)
+    station_city: dict[int, int] = field(default_factory=dict)
+    targeted: int = 0  # Fetches since the last download of the whole feed
+    seen_countries: set[str] = field(default_factory=set)  # Countries of the last learned response
+
+    def learn(self, organizations: Iterable[dict], whole_feed: bool) -> Iterator[dict]:
+        '''Record the domains and station locations of organizations while passing them through.
+
+        The domains of a country are only complete in the whole feed, which replaces them, targeted
+        responses do not add to them.'''
+        self.seen_countries = set()
+        if whole_feed:
+            self.country_domains = dict()
+        for organization in organizations:
+            domain = organization.get("domain")
+            self.seen_countries.add(organization["country"].lower())
+            if domain:
+                self.org_domain[organization["name"]] = domain
+                if whole_feed:
+                    self.country_domains.setdefault(organization["country"].lower(), set()).add(domain)
+            for city in organization["cities"]:
+                city_id = int(city["uid"])
+                if domain:
+                    self.city_domain[city_id] = domain
+                for station in city["places"]:
+                    self.station_city[int(station["uid"])] = city_id
+            yield organization
+
+
+@dataclass
+class _Tracked:
+    '''Filter on the organizations and cities of interest. Empty means everything is tracked.'''
+    country_codes: list[str]
+    organization_names: list[str]
+    city_ids: list[int]
+
+    @property
+    def everything(self) -> bool:
+        return not (self.country_codes or self.organization_names or self.city_ids)
+
+    def organization(self, organization_name: str, country_code: str) -> bool:
+        '''Whether the whole organization is tracked.'''
+        return self.everything or organization_name in self.organization_names or \
+            country_code in self.country_codes
+
+
+def _to_json_dict(obj: object) -> dict:
+    '''Public fields of a dataclass for json serialization. Cached views are left out.'''
+    return {f.name: getattr(obj, f.name) for f in fields(obj) if not f.name.startswith("_")}
+
+
+def _serialize(obj: object) -> object:
+    '''Convert an object into the same structure json.dump writes to the logfiles.'''
+    if isinstance(obj, dict):
+        return {str(k): _serialize(v) for k, v in obj.items()}
+    if hasattr(obj, "__dataclass_fields__"):
+        return {k: _serialize(v) for k, v in _to_json_dict(obj).items()}
+    return obj
+
+
+def _merge(parts: Iterable[dict]) -> tuple[dict, int]:
+    '''Merge id keyed dicts into one and count the duplicate ids.'''
+    merged = dict()
+    total = 0
+    for part in parts:
+        total += len(part)
+        merged.update(part)
+    return merged, total - len(merged)
+
+
+class _CityAggregate:
+    '''Station and bike views over the cities of a Country or Organization.
+
+    The views are built on first access and shared until the cities change.'''
+
+    @property
+    def stations(self) -> dict[int, Station]:
+        if self._stations is None:
+            self._stations, self._duplicates["stations"] = _merge(c.stations for c in self.cities.values())
+        return self._stations
+
+    @property
+    def bikes(self) -> dict[int, Bike]:
+        if self._bikes is None:
+            self._bikes, self._duplicates["bikes"] = _merge(s.bikes for s in self.stations.values())
+        return self._bikes
+
+    @property
+    def duplicates(self) -> dict[str, int]:
+        '''Number of station and bike ids registered more than once.'''
+        self.bikes
+        return dict(self._duplicates)
+
+    def _invalidate(self):
+        self._stations = None
+        self._bikes = None
+
+
+@dataclass
+class Country(_CityAggregate):
     name: str
     code: str
     lat: float
     lng: float
     cities: dict[int, City]
+    _stations: Optional[dict[int, Station]] = field(default=None, init=False, repr=False, compare=False)
+    _bikes: Optional[dict[int, Bike]] = field(default=None, init=False, repr=False, compare=False)
+    _duplicates: dict[str, int] = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    @classmethod
+    def from_dict(cls, d: dict) -> Country:
+        '''Build a Country from its logged dictionary.'''
+        country = cls(d['name'], d['code'], d['lat'], d['lng'], {})
+        for city_data in d['cities'].values():
+            country.cities[city_data['id']] = City.from_dict(city_data)
+        return country
 
     def __str__(self) -> str:
         return "Country:\n" + \
@@ -303,40 +903,32 @@ class Country:
         if city.id in self.cities:
             print(f"WARNING: Key {city.id} already registered in country '{self.code}'.\nNothing changed.")
         self.cities[city.id] = city
+        self._invalidate()
 
     def city(self, city_id: int) -> City:
         '''Get data of a specific city.'''
         return self.cities[city_id]
 
-    @property
-    def stations(self) -> dict[int, Station]:
-        s = dict()
-        for city in self.cities.values():
-            for station in city.stations.values():
-                if station.id in s.keys():
-                    print(f"WARNING: Multiple stations with ID {station.id}.")
-                s[station.id] = station
-        return s
-
-    @property
-    def bikes(self) -> dict[int, Bike]:
-        b = dict()
-        for station in self.stations.values():
-            for bike in station.bikes.values():
-                if bike.id in b.keys():
-                    print(f"WARNING: Multiple bikes with ID {bike.id}.")
-                b[bike.id] = bike
-        return b
-
 
 @dataclass
-class Organization:
+class Organization(_CityAggregate):
     name: str
     country_name: str
     country_code: str
     lat: float
     lng: float
     cities: dict[int, City]
+    _stations: Optional[dict[int, Station]] = field(default=None, init=False, repr=False, compare=False)
+    _bikes: Optional[dict[int, Bike]] = field(default=None, init=False, repr=False, compare=False)
+    _duplicates: dict[str, int] = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    @classmethod
+    def from_dict(cls, d: dict) -> Organization:
+        '''Build an Organization from its logged dictionary.'''
+        organization = cls(d['name'], d['country_name'], d['country_code'], d['lat'], d['lng'], {})
+        for city_data in d['cities'].values():
+            organization.cities[city_data['id']] = City.from_dict(city_data)
+        return organization
 
     def __str__(self) -> str:
         return f"organization:\n" + \
@@ -351,35 +943,25 @@ class Organization:
         '''Get data of a specific city.'''
         return self.cities[city_id]
 
-    @property
-    def stations(self) -> dict[int, Station]:
-        s = dict()
-        for city in self.cities.values():
-            for id, station in city.stations.items():
-                if id in s.keys():
-                    print(f"WARNING: Multiple stations with ID {id}.")
-                s[id] = station
-        return s
-
-    @property
-    def bikes(self) -> dict[int, Bike]:
-        b = dict()
-        for station in self.stations.values():
-            for id, bike in station.bikes.items():
-                if id in b.keys():
-                    print(f"WARNING: Multiple bikes with ID {id}.")
-                b[id] = bike
-        return b
-
 
 @dataclass
 class City:
+    '''A city of one snapshot. Its stations are not changed after it was built, new data builds a new City,
+    so the bikes view is cached for its lifetime and cities can be shared between fetches and cached snapshots.'''
     id: int
     name: str
     lat: float
     lng: float
     available_bikes: int
     stations: dict[int, Station]
+    _bikes: Optional[dict[int, Bike]] = field(default=None, init=False, repr=False, compare=False)
+    _duplicate_bikes: int = field(default=0, init=False, repr=False, compare=False)
+
+    @classmethod
+    def from_dict(cls, d: dict) -> City:
+        '''Build a City from its logged dictionary.'''
+        stations = {station_data['id']: Station.from_dict(station_data) for station_data in d['stations'].values()}
+        return cls(d['id'], d['name'], d['lat'], d['lng'], d['available_bikes'], stations)
 
     def __str__(self: City) -> str:
         return "City:\n" + \
@@ -396,16 +978,18 @@ class City:
 
     @property
     def bikes(self) -> dict[int, Bike]:
-        b = dict()
-        for id, station in self.stations.items():
-            for bike in station.bikes.values():
-                if id in b.keys():
-                    print(f"Multiple bikes with ID {id}.")
-                b[id] = bike
-        return b
+        if self._bikes is None:
+            self._bikes, self._duplicate_bikes = _merge(s.bikes for s in self.stations.values())
+        return self._bikes
+
+    @property
+    def duplicates(self) -> dict[str, int]:
+        '''Number of bike ids registered more than once.'''
+        self.bikes
+        return {"bikes": self._duplicate_bikes}
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Station:
     id: int
     name: str
@@ -424,6 +1008,13 @@ class Station:
                 available_bikes[id] = bike
         return available_bikes
 
+    @classmethod
+    def from_dict(cls, d: dict) -> Station:
+        '''Build a Station from its logged dictionary.'''
+        bikes = {bike_data['id']: Bike.from_dict(bike_data) for bike_data in d['bikes'].values()}
+        return cls(d['id'], d['name'], d['number'], d['lat'], d['lng'], d['free_racks'],
+                   d['bikes_available_to_rent'], bikes)
+
     def __str__(self) -> str:
         return "Station:\n" + \
             f"\tID              : {self.id}\n" + \
@@ -439,7 +1030,7 @@ class Station:
         return self.bikes[bike_id]
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Bike:
     id: int
     type: int
@@ -448,6 +1039,11 @@ class Bike:
     lat: float
     lng: float
 
+    @classmethod
+    def from_dict(cls, d: dict) -> Bike:
+        '''Build a Bike from its logged dictionary.'''
+        return cls(d['id'], d['type'], d['active'], sys.intern(d['state']), d['lat'], d['lng'])
+
     def __str__(self: Bike) -> str:
         return "Bike:\n" + \
             f"\tID     : {self.id}\n" + \
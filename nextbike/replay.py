@@ -0,0 +1,380 @@
+# Imports
+from __future__ import annotations
+import io
+import os
+import gzip
+import json
+import time
+import zlib
+import struct
+import bisect
+import hashlib
+import threading
+from datetime import datetime
+from typing import Iterator, Optional
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ["FeedArchive", "Playback", "ReplayAdapter", "ReplayServer", "filter_feed"]
+
+
+_magic = b"NBFEED1\n"
+_record_header = struct.Struct(">dBHI")  # timestamp, codec, query length, payload length
+_codecs = {None: 0, "zlib": 1, "zstd": 2}
+_repeat = 3  # Same body as the previous record of the query, no payload
+_feed_path = "/maps/nextbike-live.json"
+replay_time_header = "X-Replay-Time"
+
+
+class FeedArchive:
+    '''Append-only archive of raw feed responses, keyed by their query string.
+
+    Records are a header (timestamp, codec, lengths), the query and the optionally zlib or zstd
+    compressed body, all in one file. A body equal to the previous one of the same query is stored
+    as a header only, so unchanged feeds cost a few bytes per fetch. The index of all records is
+    built on first use by reading the headers. Record during scraping with Client(recorder=...).'''
+
+    def __init__(self, path: str = "./feed.archive", compression: Optional[str] = "zlib"):
+        if compression not in _codecs:
+            raise ValueError(f"Unknown compression '{compression}'. Choose from {list(_codecs)}.")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package.")
+        self.path = path
+        self.compression = compression
+        # query -> (timestamps, offsets of the records holding the bodies)
+        self._index: Optional[dict[str, tuple[list[float], list[int]]]] = None
+        self._digests: dict[str, bytes] = dict()
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return sum(len(times) for times, _ in self._load_index().values())
+
+    def queries(self) -> list[str]:
+        return list(self._load_index())
+
+    def timestamps(self, query: str = "") -> list[datetime]:
+        times, _ = self._load_index().get(query, ([], []))
+        return [datetime.fromtimestamp(t) for t in times]
+
+    # ------------------------ writing ----------------------------------------
+    def append(self, timestamp: datetime, query: str, body: Optional[bytes]) -> int:
+        '''Add the response body of a feed query fetched at timestamp, None if unchanged since the previous
+        record of the query. Returns the number of bytes written.'''
+        with self._lock:
+            index = self._load_index()
+            times, offsets = index.get(query, ([], []))
+            if body is None and not offsets:
+                return 0  # Nothing to repeat, e.g. recording started after the first fetch
+            digest = self._digest(query, offsets[-1]) if body is None else hashlib.sha1(body).digest()
+            if offsets and self._digest(query, offsets[-1]) == digest:
+                codec, payload = _repeat, b""
+            else:
+                codec, payload = _codecs[self.compression], self._compress(body)
+            encoded_query = query.encode("utf-8")
+            with open(self.path, "ab") as f:
+                if f.tell() > self._end:  # Drop a record cut off by a crash
+                    f.truncate(self._end)
+                    f.seek(self._end)
+                if self._end == 0:
+                    f.write(_magic)
+                offset = f.tell()
+                f.write(_record_header.pack(timestamp.timestamp(), codec, len(encoded_query), len(payload)))
+                f.write(encoded_query)
+                f.write(payload)
+                self._end = f.tell()
+            times.append(timestamp.timestamp())
+            offsets.append(offsets[-1] if codec == _repeat else offset)
+            index[query] = (times, offsets)
+            self._digests[query] = digest
+            return self._end - offset
+
+    def _compress(self, body: bytes) -> bytes:
+        if self.compression == "zlib":
+            return zlib.compress(body)
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor().compress(body)
+        return body
+
+    def _digest(self, query: str, offset: int) -> bytes:
+        if query not in self._digests:
+            self._digests[query] = hashlib.sha1(self._read(offset)).digest()
+        return self._digests[query]
+
+    # ------------------------ reading ----------------------------------------
+    def body(self, query: str, timestamp: datetime) -> bytes:
+        '''Body of the latest response to a query recorded at or before timestamp.'''
+        found = self._lookup(query, timestamp.timestamp())
+        if found is None:
+            raise KeyError(f"No response to '{query}' recorded at {timestamp}.")
+        return self._read(found[1])
+
+    def records(self) -> Iterator[tuple[datetime, str, bytes]]:
+        '''All (timestamp, query, body) records in the order they were added.'''
+        bodies: dict[str, bytes] = dict()
+        with open(self.path, "rb") as f:
+            f.seek(len(_magic))
+            while True:
+                header = f.read(_record_header.size)
+                if len(header) < _record_header.size:
+                    return
+                timestamp, codec, query_length, length = _record_header.unpack(header)
+                query = f.read(query_length).decode("utf-8")
+                if codec != _repeat:
+                    payload = f.read(length)
+                    if len(payload) < length:
+                        return
+                    bodies[query] = _decompress(codec, payload)
+                yield datetime.fromtimestamp(timestamp), query, bodies[query]
+
+    def _lookup(self, query: str, timestamp: float, earliest: bool = False) -> Optional[tuple[float, int]]:
+        '''(timestamp, body offset) of the latest record of a query not after timestamp, or with earliest
+        of the first record if all are later.'''
+        entry = self._load_index().get(query)
+        if entry is None:
+            return None
+        times, offsets = entry
+        i = max(bisect.bisect_right(times, timestamp), 1 if earliest else 0)
+        return None if i == 0 else (times[i - 1], offsets[i - 1])
+
+    def _read(self, offset: int) -> bytes:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            _, codec, query_length, length = _record_header.unpack(f.read(_record_header.size))
+            f.seek(query_length, os.SEEK_CUR)
+            return _decompress(codec, f.read(length))
+
+    def _load_index(self) -> dict[str, tuple[list[float], list[int]]]:
+        if self._index is not None:
+            return self._index
+        index: dict[str, tuple[list[float], list[int]]] = dict()
+        end = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                if f.read(len(_magic)) != _magic:
+                    raise ValueError(f"{self.path} is not a feed archive.")
+                size = os.fstat(f.fileno()).st_size
+                end = offset = len(_magic)
+                while offset + _record_header.size <= size:
+                    timestamp, codec, query_length, length = _record_header.unpack(f.read(_record_header.size))
+                    next_offset = offset + _record_header.size + query_length + length
+                    if next_offset > size:
+                        break
+                    query = f.read(query_length).decode("utf-8")
+                    times, offsets = index.setdefault(query, ([], []))
+                    if codec == _repeat and not offsets:
+                        raise ValueError(f"{self.path} is corrupt at offset {offset}.")
+                    times.append(timestamp)
+                    offsets.append(offsets[-1] if codec == _repeat else offset)
+                    f.seek(next_offset)
+                    end = offset = next_offset
+        self._index, self._end = index, end
+        return index
+
+
+def _decompress(codec: int, payload: bytes) -> bytes:
+    if codec == _codecs["zlib"]:
+        return zlib.decompress(payload)
+    if codec == _codecs["zstd"]:
+        if zstandard is None:
+            raise ValueError("Reading a zstd compressed archive requires the zstandard package.")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return payload
+
+
+class Playback:
+    '''Virtual clock over a feed archive deciding which recorded response is current.
+
+    With a speed, the clock starts at the first record (or start) when created and runs speed times
+    faster than real time. It stops at the last record, or starts over with loop. Without a speed
+    it only moves on step(), to the next recorded timestamp, which makes replays deterministic.
+    Queries that were not recorded are answered by filtering the recorded whole feed by its domains
+    and city parameters, like the live api.'''
+
+    def __init__(self, archive: FeedArchive, speed: Optional[float] = 1.0, loop: bool = False,
+                 start: Optional[datetime] = None):
+        self.archive = archive
+        self.speed = speed
+        self.loop = loop
+        self._times = sorted({t for times, _ in archive._load_index().values() for t in times})
+        if not self._times:
+            raise ValueError(f"{archive.path} holds no records.")
+        self._start = start.timestamp() if start is not None else self._times[0]
+        self._position = self._start
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._bodies: dict[tuple[str, int], bytes] = dict()
+        self._feed: Optional[tuple[int, list[dict]]] = None
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self._now())
+
+    @property
+    def finished(self) -> bool:
+        return not self.loop and self._now() >= self._times[-1]
+
+    def step(self) -> bool:
+        '''Move to the next recorded timestamp. Returns False at the end of the archive.'''
+        if self.speed is not None:
+            raise ValueError("Only a playback without speed is stepped.")
+        i = bisect.bisect_right(self._times, self._position)
+        if i == len(self._times):
+            return False
+        self._position = self._times[i]
+        return True
+
+    def _now(self) -> float:
+        if self.speed is None:
+            return self._position
+        elapsed = (time.monotonic() - self._started) * self.speed
+        duration = self._times[-1] - self._start
+        if self.loop and duration > 0:
+            return self._start + elapsed % duration
+        return min(self._start + elapsed, max(self._times[-1], self._start))
+
+    def response(self, query: str) -> tuple[bytes, str]:
+        '''Body and ETag of the response to a feed query string at the current time.'''
+        now = self._now()
+        recorded = query in self.archive._load_index()
+        lookup = query if recorded else ""
+        found = self.archive._lookup(lookup, now, earliest=True)
+        if found is None:
+            raise KeyError(f"No response to '{query}' recorded.")
+        offset = found[1]
+        with self._lock:
+            body = self._bodies.get((query, offset))
+            if body is None:
+                body = self.archive._read(offset) if recorded else self._filter(offset, query)
+                if len(self._bodies) >= 64:
+                    self._bodies.pop(next(iter(self._bodies)))
+                self._bodies[(query, offset)] = body
+        etag = f'"{offset:x}"' if recorded else f'"{offset:x}-{zlib.crc32(query.encode()):x}"'
+        return body, etag
+
+    def _filter(self, offset: int, query: str) -> bytes:
+        if self._feed is None or self._feed[0] != offset:
+            self._feed = (offset, json.loads(self.archive._read(offset))["countries"])
+        return filter_feed(self._feed[1], query)
+
+
+def filter_feed(organizations: list[dict], query: str) -> bytes:
+    '''Feed body with the organizations and cities selected by the domains and city parameters of a query.'''
+    params = parse_qs(query)
+    domains = set(",".join(params.get("domains", [])).split(",")) - {""}
+    city_ids = {int(id) for id in ",".join(params.get("city", [])).split(",") if id}
+    result = []
+    for organization in organizations:
+        if organization.get("domain") in domains:
+            result.append(organization)
+        elif city_ids:
+            cities = [city for city in organization["cities"] if city["uid"] in city_ids]
+            if cities:
+                result.append(dict(organization, cities=cities))
+    return json.dumps({"countries": result}, separators=(",", ":")).encode()
+
+
+class ReplayAdapter(HTTPAdapter):
+    '''Transport adapter answering feed requests of a requests session from a playback, without a server.'''
+
+    def __init__(self, playback: Playback):
+        super().__init__()
+        self.playback = playback
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        try:
+            body, etag = self.playback.response(urlsplit(request.url).query)
+            status = 304 if request.headers.get("If-None-Match") == etag else 200
+        except KeyError:
+            body, etag, status = b"", "", 404
+        if status != 200:
+            body = b""
+        headers = {"Content-Type": "application/json", "Content-Length": str(len(body)), "ETag": etag,
+                   replay_time_header: self.playback.now().isoformat()}
+        raw = HTTPResponse(body=io.BytesIO(body), headers=headers, status=status, preload_content=False,
+                           decode_content=False, request_url=request.url)
+        return self.build_response(request, raw)
+
+
+class ReplayServer:
+    '''Local http stand-in for the nextbike api replaying a feed archive.
+
+    Serves the response current on a Playback at the given speed, e.g. speed=100 replays an hour in
+    36 seconds. Supports gzip content encoding and ETag based conditional requests. Use as a context
+    manager and point a client at url.'''
+
+    def __init__(self, archive: FeedArchive, speed: Optional[float] = 1.0, loop: bool = False,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.playback = Playback(archive, speed, loop)
+        self._compressed: dict[str, bytes] = dict()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{_feed_path}"
+
+    def __enter__(self) -> ReplayServer:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _gzip(self, body: bytes, etag: str) -> bytes:
+        with self._lock:
+            compressed = self._compressed.get(etag)
+            if compressed is None:
+                compressed = gzip.compress(body, compresslevel=6)
+                if len(self._compressed) >= 64:
+                    self._compressed.pop(next(iter(self._compressed)))
+                self._compressed[etag] = compressed
+            return compressed
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                url = urlsplit(self.path)
+                try:
+                    if url.path != _feed_path:
+                        raise KeyError(url.path)
+                    body, etag = server.playback.response(url.query)
+                except KeyError:
+                    self.send_error(404)
+                    return
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    body = b""
+                else:
+                    self.send_response(200)
+                    if "gzip" in self.headers.get("Accept-Encoding", ""):
+                        body = server._gzip(body, etag)
+                        self.send_header("Content-Encoding", "gzip")
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.send_header(replay_time_header, server.playback.now().isoformat())
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,247 @@
+# Imports
+from __future__ import annotations
+import os
+import json
+import math
+import time
+import queue
+import signal
+import multiprocessing as mp
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional
+
+from .utils import log_timestamp_format
+from .nextbike import Client, _to_json_dict, _serialize
+
+if TYPE_CHECKING:
+    from .history import HistoryStore
+
+__all__ = ["ShardedScraper"]
+
+
+@dataclass
+class _Shard:
+    '''Targets scraped by one worker process.'''
+    country_codes: list[str] = field(default_factory=list)
+    organization_names: list[str] = field(default_factory=list)
+    city_ids: list[int] = field(default_factory=list)
+
+    def targets(self) -> list[tuple[str, str | int]]:
+        return [("countries", code) for code in self.country_codes] + \
+            [("organizations", name) for name in self.organization_names] + \
+            [("cities", id) for id in self.city_ids]
+
+
+@dataclass
+class _Schedule:
+    '''Ticks are due at origin + tick * interval_secs, in seconds since the epoch.'''
+    origin: float
+    interval_secs: float
+    first_tick: int
+    max_ticks: Optional[int] = None
+
+    def due(self, tick: int) -> float:
+        return self.origin + tick * self.interval_secs
+
+    def next_tick(self, now: float) -> int:
+        return math.ceil((now - self.origin) / self.interval_secs)
+
+
+class ShardedScraper:
+    '''Scrape many countries, organizations and cities with several worker processes and one writer process.
+
+    The targets are split into one shard per worker. Every worker fetches only its shard on a
+    shared fixed-rate schedule, skipping ticks it overran, and encodes the logs itself. The writer
+    receives the logs of all workers through a queue and writes them in batches, either as JSON
+    logfiles like Client.log_* or into a history store.
+
+    After every batch the writer records the last tick completed by all workers in a checkpoint file,
+    by default <logfolder>/.scrape_checkpoint.json. A restarted scraper continues the schedule
+    after that tick. SIGINT and SIGTERM stop the workers after their current tick, then the writer
+    drains the queue and writes the final checkpoint. A worker that dies, e.g. killed by the OOM
+    killer, does not stop the others, but the checkpoint does not advance past its last tick. Station and bike ids are not supported, they
+    would require every worker to fetch the whole feed.'''
+
+    def __init__(self, interval_secs: float,
+                 country_codes: list[str] = [],
+                 organization_names: list[str] = [],
+                 city_ids: list[int] = [],
+                 workers: int = 4,
+                 logfolder: str = "./logfiles",
+                 store: Optional[HistoryStore] = None,
+                 stream: bool = False,
+                 batch_size: int = 256,
+                 flush_secs: float = 5,
+                 checkpoint: Optional[str] = None):
+        targets = [("countries", code) for code in country_codes] + \
+            [("organizations", name) for name in organization_names] + [("cities", id) for id in city_ids]
+        if not targets:
+            raise ValueError("Nothing to scrape. Give country codes, organization names or city ids.")
+        self.interval_secs = interval_secs
+        self.shards = [_Shard() for _ in range(min(workers, len(targets)))]
+        for i, (typ, id) in enumerate(targets):  # Countries first, so they spread over the workers
+            shard = self.shards[i % len(self.shards)]
+            {"countries": shard.country_codes, "organizations": shard.organization_names,
+             "cities": shard.city_ids}[typ].append(id)
+        self.logfolder = logfolder
+        self.store = store
+        self.stream = stream
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.checkpoint = checkpoint or os.path.join(store.folder if store is not None else logfolder,
+                                                     ".scrape_checkpoint.json")
+        # A lock free flag, workers killed while waiting on an mp.Event would block setting it forever
+        self._stop = mp.RawValue("b", 0)
+        self._url = Client._url
+
+    def run(self, max_ticks: Optional[int] = None) -> int:
+        '''Scrape until stopped, or for max_ticks ticks. Returns the last tick completed by all workers.'''
+        schedule = self._schedule(max_ticks)
+        results = mp.Queue()
+        writer = mp.Process(target=_write, args=(results, len(self.shards), self.logfolder, self.store,
+                                                 self.checkpoint, schedule, self.batch_size, self.flush_secs),
+                            name="nextbike-writer")
+        encode = self.store is None
+        processes = [mp.Process(target=_scrape, name=f"nextbike-worker-{i}",
+                                args=(i, shard, schedule, self.stream, encode, self._url, results, self._stop))
+                     for i, shard in enumerate(self.shards)]
+        handlers = {sig: signal.signal(sig, lambda *_: self.stop()) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            writer.start()
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+                if process.exitcode != 0:
+                    print(f"{process.name} exited with code {process.exitcode}, its last ticks are not checkpointed.")
+            # Sent once all workers exited, so a killed worker cannot keep the writer waiting
+            results.put((None, None, []))
+            writer.join()
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+        return _read_checkpoint(self.checkpoint).get("tick", schedule.first_tick - 1)
+
+    def stop(self):
+        '''Stop after the current tick. Safe to call from a signal handler.'''
+        self._stop.value = 1
+
+    def _schedule(self, max_ticks: Optional[int]) -> _Schedule:
+        '''Continue the schedule of the checkpoint if it has the same interval, otherwise start now.'''
+        now = time.time()
+        checkpoint = _read_checkpoint(self.checkpoint)
+        if checkpoint.get("interval_secs") == self.interval_secs:
+            schedule = _Schedule(checkpoint["origin"], self.interval_secs, 0, max_ticks)
+            schedule.first_tick = max(checkpoint["tick"] + 1, schedule.next_tick(now))
+            return schedule
+        return _Schedule(now, self.interval_secs, 0, max_ticks)
+
+
+# ------------------------ processes -----------------------------------------
+def _scrape(worker: int, shard: _Shard, schedule: _Schedule, stream: bool, encode: bool, url: str,
+            results: mp.Queue, stop):
+    '''Worker process: fetch the shard on schedule and send (worker, tick, records) to the writer.
+
+    With encode the records hold the finished logfile contents, otherwise the dictionaries for the store.'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Stopped through the event
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    client = Client(_url=url)
+    getters = {"countries": client.get_country, "organizations": client.get_organization, "cities": client.get_city}
+    tick = schedule.first_tick
+    last_tick = None if schedule.max_ticks is None else schedule.first_tick + schedule.max_ticks - 1
+    while last_tick is None or tick <= last_tick:
+        if _wait(stop, schedule.due(tick)):
+            break
+        records = []
+        try:
+            if client.fetch(stream, shard.country_codes, shard.organization_names, shard.city_ids):
+                timestamp = client.fetched_at
+                for typ, id in shard.targets():
+                    obj = getters[typ](id)
+                    if encode:
+                        data = json.dumps(obj, default=_to_json_dict, ensure_ascii=False, sort_keys=True,
+                                          indent=4).encode("utf-8")
+                    else:
+                        data = _serialize(obj)
+                    records.append((typ, str(id), timestamp, data))
+        except Exception as e:
+            print(f"Worker {worker} failed to scrape tick {tick}: {e}")
+        results.put((worker, tick, records))
+        tick = max(tick + 1, schedule.next_tick(time.time()))  # Skip overrun ticks
+
+
+def _wait(stop, until: float, poll_secs: float = 0.1) -> bool:
+    '''Sleep until a time or until the stop flag is set. Returns whether it was set.'''
+    while not stop.value:
+        remaining = until - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(remaining, poll_secs))
+    return True
+
+
+def _write(results: mp.Queue, workers: int, logfolder: str, store: Optional[HistoryStore], checkpoint: str,
+           schedule: _Schedule, batch_size: int, flush_secs: float):
+    '''Writer process: write the records of all workers in batches and checkpoint completed ticks.'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Stops on the sentinel sent after the workers exited
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    buffer = []
+    folders = set()
+    last_ticks = [schedule.first_tick - 1] * workers
+    done = False
+    flushed_at = time.monotonic()
+    while not done:
+        try:
+            worker, tick, records = results.get(timeout=flush_secs)
+            if worker is None:
+                done = True
+            else:
+                buffer.extend(records)
+                last_ticks[worker] = tick
+        except queue.Empty:
+            pass
+        if len(buffer) >= batch_size or time.monotonic() - flushed_at >= flush_secs or done:
+            _flush(buffer, logfolder, store, folders)
+            buffer = []
+            flushed_at = time.monotonic()
+            completed = min(last_ticks)
+            if completed >= schedule.first_tick:
+                _write_checkpoint(checkpoint, schedule, completed)
+
+
+def _flush(buffer: list[tuple], logfolder: str, store: Optional[HistoryStore], folders: set[str]):
+    if store is not None:
+        for typ, id, timestamp, data in sorted(buffer, key=lambda record: record[2]):
+            store.append(typ, id, timestamp, data)
+        store.flush()  # Checkpointed ticks have to be written
+        return
+    for typ, id, timestamp, payload in buffer:
+        folder = os.path.join(logfolder, typ, id)
+        if folder not in folders:
+            os.makedirs(folder, exist_ok=True)
+            folders.add(folder)
+        with open(os.path.join(folder, f"log_{timestamp.strftime(log_timestamp_format)}.json"), "wb") as f:
+            f.write(payload)
+
+
+def _read_checkpoint(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _write_checkpoint(path: str, schedule: _Schedule, tick: int):
+    checkpoint = {
+        "origin": schedule.origin,
+        "interval_secs": schedule.interval_secs,
+        "tick": tick,
+        "timestamp": datetime.fromtimestamp(schedule.due(tick)).isoformat(),
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, path)
@@ -0,0 +1,255 @@
+# Imports
+from __future__ import annotations
+import math
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+
+from .nextbike import Station, Bike
+
+__all__ = ["SpatialIndex", "haversine", "earth_radius"]
+
+
+earth_radius = 6371008.8  # meters
+_meters_per_degree = math.pi * earth_radius / 180
+
+
+def haversine(lat1, lng1, lat2, lng2) -> np.ndarray:
+    '''Great circle distance in meters. Broadcasts over numpy arrays.'''
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * earth_radius * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class SpatialIndex:
+    '''Grid index over the positions of stations or bikes.
+
+    Points are bucketed into cells of cell_deg x cell_deg degrees. Queries search widening bands of
+    cells around the query point until no closer point can exist, using haversine distances, so only
+    the cells near the query point are touched. The *_many methods answer whole arrays of query
+    points, evaluating each group of queries sharing a cell against its candidates at once.'''
+
+    def __init__(self, ids: np.ndarray, lats: np.ndarray, lngs: np.ndarray,
+                 resolve: Callable[[int], Station | Bike], cell_deg: float = 0.01):
+        self.cell_deg = cell_deg
+        self.resolve = resolve
+        ci = np.floor(np.asarray(lats, dtype=np.float64) / cell_deg).astype(np.int64)
+        cj = np.floor(np.asarray(lngs, dtype=np.float64) / cell_deg).astype(np.int64)
+        order = np.lexsort((cj, ci))
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.lats = np.asarray(lats, dtype=np.float64)[order]
+        self.lngs = np.asarray(lngs, dtype=np.float64)[order]
+        self._order = order
+        # Occupied cells with the range of their points in the sorted arrays
+        ci, cj = ci[order], cj[order]
+        starts = np.flatnonzero(np.r_[True, (ci[1:] != ci[:-1]) | (cj[1:] != cj[:-1])]) if len(order) else \
+            np.zeros(0, dtype=np.int64)
+        self._cell_i, self._cell_j = ci[starts], cj[starts]
+        self._cell_start, self._cell_end = starts, np.r_[starts[1:], len(order)].astype(np.int64)
+        # Sorted keys of the occupied cells to look up the cells around a query point
+        if len(starts):
+            self._bounds = (int(self._cell_i.min()), int(self._cell_i.max()),
+                            int(self._cell_j.min()), int(self._cell_j.max()))
+        else:
+            self._bounds = (0, -1, 0, -1)
+        self._width = self._bounds[3] - self._bounds[2] + 1
+        self._cell_key = (self._cell_i - self._bounds[0]) * self._width + (self._cell_j - self._bounds[2])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_stations(cls, stations: Iterable[Station], cell_deg: float = 0.01) -> SpatialIndex:
+        return cls._from_objects(list(stations), cell_deg)
+
+    @classmethod
+    def from_bikes(cls, bikes: Iterable[Bike], cell_deg: float = 0.01) -> SpatialIndex:
+        return cls._from_objects(list(bikes), cell_deg)
+
+    @classmethod
+    def _from_objects(cls, objects: list[Station | Bike], cell_deg: float) -> SpatialIndex:
+        by_id = {o.id: o for o in objects}
+        return cls(np.fromiter((o.id for o in objects), dtype=np.int64, count=len(objects)),
+                   np.fromiter((o.lat for o in objects), dtype=np.float64, count=len(objects)),
+                   np.fromiter((o.lng for o in objects), dtype=np.float64, count=len(objects)),
+                   by_id.__getitem__, cell_deg)
+
+    # ------------------------ single queries ---------------------------------
+    def nearest(self, lat: float, lng: float, k: int = 1,
+                predicate: Optional[Callable[[Station | Bike], bool]] = None) -> list[tuple[float, Station | Bike]]:
+        '''The k nearest objects to a point satisfying the predicate, as (distance in meters, object) pairs.'''
+        ids, dists = self.nearest_many([lat], [lng], k, predicate=predicate)
+        return [(float(d), self.resolve(int(id))) for id, d in zip(ids[0], dists[0]) if id >= 0]
+
+    def within_radius(self, lat: float, lng: float, radius_m: float,
+                      predicate: Optional[Callable[[Station | Bike], bool]] = None) -> list[tuple[float, Station | Bike]]:
+        '''All objects within radius_m meters of a point satisfying the predicate, nearest first.'''
+        ids, dists = self.within_radius_many([lat], [lng], radius_m)[0]
+        result = [(float(d), self.resolve(int(id))) for id, d in zip(ids, dists)]
+        if predicate is not None:
+            result = [(d, o) for d, o in result if predicate(o)]
+        return result
+
+    def within_bbox(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float,
+                    predicate: Optional[Callable[[Station | Bike], bool]] = None) -> list[Station | Bike]:
+        '''All objects inside a bounding box satisfying the predicate. Only the points of the occupied cells
+        overlapping the box are tested.'''
+        # Cells are sorted by row, then column
+        first = np.searchsorted(self._cell_i, math.floor(min_lat / self.cell_deg), side="left")
+        last = np.searchsorted(self._cell_i, math.floor(max_lat / self.cell_deg), side="right")
+        cj = self._cell_j[first:last]
+        cells = first + np.flatnonzero((cj >= math.floor(min_lng / self.cell_deg)) &
+                                       (cj <= math.floor(max_lng / self.cell_deg)))
+        if not len(cells):
+            return []
+        points = np.concatenate([np.arange(self._cell_start[c], self._cell_end[c], dtype=np.int64)
+                                 for c in cells.tolist()])
+        lats, lngs = self.lats[points], self.lngs[points]
+        inside = points[(lats >= min_lat) & (lats <= max_lat) & (lngs >= min_lng) & (lngs <= max_lng)]
+        objects = [self.resolve(id) for id in self.ids[inside].tolist()]
+        if predicate is not None:
+            objects = [o for o in objects if predicate(o)]
+        return objects
+
+    # ------------------------ batch queries ----------------------------------
+    def nearest_many(self, lats, lngs, k: int = 1, mask: Optional[np.ndarray] = None,
+                     predicate: Optional[Callable[[Station | Bike], bool]] = None) -> tuple[np.ndarray, np.ndarray]:
+        '''The k nearest objects for many query points.
+
+        mask is an optional boolean array over the indexed points in insertion order, a vectorized
+        alternative to predicate. Returns ids and distances in meters of shape (len(lats), k),
+        nearest first. Missing neighbours have id -1 and distance inf.'''
+        lats, lngs = np.atleast_1d(np.asarray(lats, dtype=np.float64)), np.atleast_1d(np.asarray(lngs, dtype=np.float64))
+        allowed = self._allowed(mask)
+        out_ids = np.full((len(lats), k), -1, dtype=np.int64)
+        out_dists = np.full((len(lats), k), np.inf)
+        for queries, ci, cj in self._query_groups(lats, lngs):
+            q_lat, q_lng = lats[queries][:, None], lngs[queries][:, None]
+            # Running k nearest of the rings seen so far, merged with the points of each new ring
+            best = np.zeros((len(queries), 0), dtype=np.int64)
+            best_dists = np.zeros((len(queries), 0))
+            found = 0
+            for _, r, ring in self._rings(ci, cj):
+                if allowed is not None:
+                    ring = ring[allowed[ring]]
+                if predicate is not None:
+                    ring = ring[np.fromiter((predicate(self.resolve(id)) for id in self.ids[ring].tolist()),
+                                            dtype=bool, count=len(ring))]
+                if len(ring):
+                    dists = haversine(q_lat, q_lng, self.lats[ring][None, :], self.lngs[ring][None, :])
+                    points = np.broadcast_to(ring, dists.shape)
+                    if best_dists.shape[1]:
+                        dists = np.concatenate([best_dists, dists], axis=1)
+                        points = np.concatenate([best, points], axis=1)
+                    keep = np.argsort(dists, axis=1, kind="stable")[:, :k]
+                    best, best_dists = np.take_along_axis(points, keep, axis=1), np.take_along_axis(dists, keep, axis=1)
+                    found += len(ring)
+                # Points in further rings are at least r cells away
+                if found >= k and best_dists[:, k - 1].max() <= r * self._cell_meters(ci, r + 1):
+                    break
+            if found == 0:
+                continue
+            n = min(k, found)
+            out_ids[queries, :n] = self.ids[best[:, :n]]
+            out_dists[queries, :n] = best_dists[:, :n]
+        return out_ids, out_dists
+
+    def within_radius_many(self, lats, lngs, radius_m: float,
+                           mask: Optional[np.ndarray] = None) -> list[tuple[np.ndarray, np.ndarray]]:
+        '''Ids and distances of all objects within radius_m meters, nearest first, for many query points.'''
+        lats, lngs = np.atleast_1d(np.asarray(lats, dtype=np.float64)), np.atleast_1d(np.asarray(lngs, dtype=np.float64))
+        allowed = self._allowed(mask)
+        result = [(np.zeros(0, dtype=np.int64), np.zeros(0))] * len(lats)
+        for queries, ci, cj in self._query_groups(lats, lngs):
+            candidates = [np.zeros(0, dtype=np.int64)]
+            for r, _, ring in self._rings(ci, cj):
+                if (r - 1) * self._cell_meters(ci, r) > radius_m:
+                    break
+                candidates.append(ring)
+            candidates = np.concatenate(candidates)
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            dists = haversine(lats[queries][:, None], lngs[queries][:, None],
+                              self.lats[candidates][None, :], self.lngs[candidates][None, :])
+            for row, query in enumerate(queries.tolist()):
+                inside = np.flatnonzero(dists[row] <= radius_m)
+                inside = inside[np.argsort(dists[row][inside], kind="stable")]
+                result[query] = (self.ids[candidates][inside], dists[row][inside])
+        return result
+
+    # ------------------------ grid -------------------------------------------
+    def _allowed(self, mask: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        '''Mask over the points in insertion order reordered like the sorted points.'''
+        return None if mask is None else np.asarray(mask, dtype=bool)[self._order]
+
+    def _query_groups(self, lats: np.ndarray, lngs: np.ndarray):
+        '''Yield (query indices, cell row, cell column) for the queries sharing a cell.'''
+        ci = np.floor(lats / self.cell_deg).astype(np.int64)
+        cj = np.floor(lngs / self.cell_deg).astype(np.int64)
+        order = np.lexsort((cj, ci))
+        if not len(order):
+            return
+        bounds = np.flatnonzero(np.r_[True, (ci[order][1:] != ci[order][:-1]) | (cj[order][1:] != cj[order][:-1]), True])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            queries = order[start:end]
+            yield queries, int(ci[queries[0]]), int(cj[queries[0]])
+
+    def _rings(self, ci: int, cj: int) -> Iterator[tuple[int, int, np.ndarray]]:
+        '''Yield (first, last, point indices) for bands of the cells at Chebyshev distance first to last from a
+        cell, nearest first.
+
+        Bands double in width. The cells of a band are looked up as one key range per row of the sorted
+        cell keys, so only the cells near the query are touched. Once a band has more rows than there are
+        occupied cells, the remaining ones are ordered by their distance instead, which bounds queries far
+        away from all points.'''
+        min_i, max_i, min_j, max_j = self._bounds
+        last = max(ci - min_i, max_i - ci, cj - min_j, max_j - cj)
+        first, width = 0, 1
+        while first <= last:
+            if 2 * first > len(self._cell_key):
+                yield from self._scan_rings(ci, cj, first)
+                return
+            yield first, first + width - 1, self._points(self._band_cells(ci, cj, first, first + width - 1))
+            first, width = first + width, 2 * width
+
+    def _band_cells(self, ci: int, cj: int, first: int, last: int) -> np.ndarray:
+        '''Indices of the occupied cells at Chebyshev distance first to last from a cell.'''
+        min_i, max_i, min_j, max_j = self._bounds
+        rows = np.arange(max(ci - last, min_i), min(ci + last, max_i) + 1)
+        # Rows crossing the inner square have a segment left and one right of it
+        inner = rows[np.abs(rows - ci) < first]
+        lo = np.r_[np.full(len(rows), max(cj - last, min_j)), np.full(len(inner), max(cj + first, min_j))]
+        hi = np.r_[np.where(np.abs(rows - ci) < first, min(cj - first, max_j), min(cj + last, max_j)),
+                   np.full(len(inner), min(cj + last, max_j))]
+        base = (np.r_[rows, inner] - min_i) * self._width - min_j
+        return _expand(np.searchsorted(self._cell_key, base + lo, side="left"),
+                       np.searchsorted(self._cell_key, np.maximum(base + hi, base + lo - 1), side="right"))
+
+    def _scan_rings(self, ci: int, cj: int, first: int) -> Iterator[tuple[int, int, np.ndarray]]:
+        '''Yield (r, r, point indices) for the occupied cells at Chebyshev distance r >= first, nearest first.'''
+        cheb = np.maximum(np.abs(self._cell_i - ci), np.abs(self._cell_j - cj))
+        cells = np.flatnonzero(cheb >= first)
+        cells = cells[np.argsort(cheb[cells], kind="stable")]
+        cheb = cheb[cells]
+        bounds = np.flatnonzero(np.r_[True, cheb[1:] != cheb[:-1], True]) if len(cheb) else []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield int(cheb[start]), int(cheb[start]), self._points(cells[start:end])
+
+    def _points(self, cells: np.ndarray) -> np.ndarray:
+        '''Indices of the points in the sorted arrays of some cells.'''
+        return _expand(self._cell_start[cells], self._cell_end[cells])
+
+    def _cell_meters(self, ci: int, r: int) -> float:
+        '''Smallest cell side in meters within r rings around cell row ci.'''
+        max_lat = min(89.9, max(abs(ci - r), abs(ci + r + 1)) * self.cell_deg)
+        return self.cell_deg * _meters_per_degree * math.cos(math.radians(max_lat))
+
+
+def _expand(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    '''Concatenation of the ranges start to end, empty ones included.'''
+    counts = np.maximum(ends - starts, 0)
+    total = int(counts.sum())
+    if not total:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return offsets + np.arange(total, dtype=np.int64)
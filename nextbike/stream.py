@@ -0,0 +1,71 @@
+# Imports
+import re
+import json
+import codecs
+from typing import BinaryIO, Iterator
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+_array_start = re.compile(r'"countries"\s*:\s*\[')
+_whitespace = " \t\n\r,"
+
+
+def iter_organizations(fp: BinaryIO, chunk_size: int = 1 << 16) -> Iterator[dict]:
+    '''Iterate over the organizations of a nextbike-live.json body without loading the whole document.
+
+    Each organization (entry of the "countries" array) is decoded on its own and yielded,
+    so at most one organization is held in memory as raw data. Uses ijson if installed.'''
+    if ijson is not None:
+        yield from ijson.items(fp, "countries.item", use_float=True)
+        return
+    yield from _iter_organizations(fp, chunk_size)
+
+
+def _iter_organizations(fp: BinaryIO, chunk_size: int) -> Iterator[dict]:
+    '''Pure python fallback of iter_organizations.'''
+    decoder = json.JSONDecoder()
+    reader = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    eof = False
+
+    def read(size: int) -> bool:
+        nonlocal buf, eof
+        chunk = fp.read(size)
+        if not chunk:
+            eof = True
+            buf += reader.decode(b"", final=True)
+            return False
+        buf += reader.decode(chunk)
+        return True
+
+    # Seek to the beginning of the organization array
+    while (match := _array_start.search(buf)) is None:
+        if not read(chunk_size):
+            raise ValueError("Malformed feed: no 'countries' array found.")
+    buf = buf[match.end():]
+
+    pos = 0
+    while True:
+        while pos < len(buf) and buf[pos] in _whitespace:
+            pos += 1
+        if pos == len(buf):
+            buf, pos = "", 0
+            if not read(chunk_size):
+                raise ValueError("Malformed feed: unexpected end of data.")
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            organization, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # Grow the read size with the buffer so large organizations are not re-decoded too often
+            read(max(chunk_size, len(buf) - pos))
+            continue
+        yield organization
+        buf, pos = buf[end:], 0
@@ -0,0 +1,95 @@
+# Imports
+from __future__ import annotations
+from datetime import datetime, timedelta
+from dataclasses import dataclass
+from typing import Optional
+
+from .diff import Snapshot, SnapshotDiff, diff
+
+__all__ = ["Trip", "BikeTracker"]
+
+
+@dataclass
+class Trip:
+    '''A bike that left one station and was seen again at another.
+
+    departure is the last time the bike was seen at the origin, arrival the first time it was seen
+    at the destination, so duration is an upper bound limited by the fetch interval.'''
+    bike_id: int
+    origin: int
+    destination: int
+    departure: datetime
+    arrival: datetime
+
+    @property
+    def duration(self) -> timedelta:
+        return self.arrival - self.departure
+
+
+class BikeTracker:
+    '''Incremental per bike state tracking and trip reconstruction from successive snapshots.
+
+    For every bike a compact record (station id, state, timestamp, in transit) is kept:
+        at a station : the station, the current state and when it was first seen there
+        in transit   : the origin station, the last state and when it was last seen there
+
+    Records are only updated from the changes of a SnapshotDiff. apply(client.changes()) after every
+    fetch does work growing with the number of changed stations and bikes, not with the size of the
+    fleet. update diffs whole snapshots instead, which scans every bike. Trips back to the origin station
+    are dropped unless round_trips is set and trips longer than max_duration, e.g. bikes taken out for
+    maintenance, are dropped if it is given.'''
+
+    def __init__(self, round_trips: bool = False, max_duration: Optional[timedelta] = None):
+        self.round_trips = round_trips
+        self.max_duration = max_duration
+        self.records: dict[int, tuple[int, str, datetime, bool]] = dict()
+        self.previous: Optional[Snapshot] = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def update(self, snapshot: Snapshot) -> list[Trip]:
+        '''Diff a snapshot against the previous one and apply the changes. Returns the completed trips.
+
+        Diffing scans every bike of both snapshots, prefer apply(client.changes()) for a fetching client.'''
+        previous, self.previous = self.previous, snapshot
+        if previous is None:
+            for id, (station, state, _) in snapshot.bikes.items():
+                self.records[id] = (station, state, snapshot.timestamp, False)
+            return []
+        return self.apply(diff(previous, snapshot))
+
+    def apply(self, d: SnapshotDiff) -> list[Trip]:
+        '''Apply the changes of a diff to the records. Returns the completed trips.'''
+        trips = []
+        records = self.records
+        for id, (station, state, _) in d.bikes_removed.items():
+            records[id] = (station, state, d.previous, True)
+        for id, (station, state, _) in d.bikes_added.items():
+            record = records.get(id)
+            if record is not None and record[3]:
+                self._trip(trips, id, record[0], station, record[2], d.current)
+            records[id] = (station, state, d.current, False)
+        for move in d.bikes_moved:
+            # Seen at another station without disappearing in between, e.g. for long fetch intervals
+            record = records.get(move.id)
+            state = record[1] if record is not None else ""
+            self._trip(trips, move.id, move.from_station, move.to_station, d.previous, d.current)
+            records[move.id] = (move.to_station, state, d.current, False)
+        for change in d.bikes_changed:
+            record = records.get(change.id)
+            if record is not None:
+                records[change.id] = (record[0], change.state[1], record[2], record[3])
+        return trips
+
+    def _trip(self, trips: list[Trip], id: int, origin: int, destination: int,
+              departure: datetime, arrival: datetime):
+        if origin == destination and not self.round_trips:
+            return
+        if self.max_duration is not None and arrival - departure > self.max_duration:
+            return
+        trips.append(Trip(id, origin, destination, departure, arrival))
+
+    def in_transit(self) -> dict[int, tuple[int, datetime]]:
+        '''Bikes currently not seen at any station: bike id -> (origin station, last seen).'''
+        return {id: (r[0], r[2]) for id, r in self.records.items() if r[3]}
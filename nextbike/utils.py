@@ -47,3 +47,5 @@ country_code_map = {
     "gb": (55.3781, -3.436),     # United Kingdom
     "va": (41.9029, 12.4534),    # Vatican City
 }
+
+log_timestamp_format = "%Y_%m_%d__%H_%M_%S"
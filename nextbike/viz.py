@@ -1,40 +1,72 @@
 import os
+import json
 import folium
-from folium.plugins import HeatMap
-from typing import Optional
+import numpy as np
+from datetime import datetime, timedelta
+from folium.plugins import HeatMap, HeatMapWithTime, FastMarkerCluster
+from folium.utilities import JsCode
+from typing import Iterable, Optional
 
 from .nextbike import Country, Organization, City
 
+__all__ = ["bikemap", "heatmap", "heatmap_timelapse", "heatmap_frames"]
 
-def bikemap(obj: Country | Organization | City, folder: Optional[str] = None, filename: Optional[str] = None):
+
+_colors = ["green", "red", "blue"]  # Station with bikes, station without bikes, single bike
+
+
+def bikemap(obj: Country | Organization | City, folder: Optional[str] = None, filename: Optional[str] = None,
+            mode: str = "markers", data_only: bool = False):
+    '''Create an html map of all stations.
+
+    mode is one of
+        "markers" : one icon marker per station, fine for single cities
+        "cluster" : clustered circle markers, the points are embedded as compact arrays
+        "geojson" : canvas rendered circle markers loaded from a separate GeoJSON file next to the
+                    html file, which has to be served over http. The html file stays the same size
+                    for any number of stations.
+    With data_only the GeoJSON file is written without the html file, to refresh an existing
+    "geojson" map.'''
+    if mode not in ("markers", "cluster", "geojson"):
+        raise ValueError(f"Unknown mode '{mode}'. Choose from 'markers', 'cluster' or 'geojson'.")
     if folder is None:
         folder = "bikemaps"
         os.makedirs(folder, exist_ok=True)
     if filename is None:
         filename = "bikemap.html"
     save_path = os.path.join(folder, filename)
+    data_filename = os.path.splitext(filename)[0] + ".geojson"
 
-    d_lat = max(obj.stations.values(), key=lambda x: x.lat).lat - min(obj.stations.values(), key=lambda x: x.lat).lat
-    d_lng = max(obj.stations.values(), key=lambda x: x.lng).lng - min(obj.stations.values(), key=lambda x: x.lng).lng
-    scale = max(d_lat, d_lng)
-
-    zoom_start = 13 - int(scale)  # approximate scale
-    map = folium.Map(location=[obj.lat, obj.lng], zoom_start=zoom_start)
-
-    for s in obj.stations.values():
-        if "bike" in s.name.lower():  # Single bikes (not stations)
-            color = "blue"
-        elif s.bikes_available_to_rent == 0:  # Normal station without bikes
-            color = "red"
-        else:  # Normal station with bikes
-            color = "green"
-
-        marker = folium.Marker(
-            location=[s.lat, s.lng],
-            icon=folium.Icon(icon="bicycle", prefix="fa", color=color),
-            popup=f"{s.name}: {s.bikes_available_to_rent}"
+    points = _station_points(obj)
+    if data_only or mode == "geojson":
+        _write_geojson(points, os.path.join(folder, data_filename))
+        if data_only:
+            return
+
+    map = folium.Map(location=[obj.lat, obj.lng], zoom_start=_zoom_start(points["lat"], points["lng"]),
+                     prefer_canvas=mode != "markers")
+    if mode == "markers":
+        for lat, lng, color, name, bikes in zip(points["lat"].tolist(), points["lng"].tolist(),
+                                                points["color"].tolist(), points["name"], points["bikes"].tolist()):
+            marker = folium.Marker(
+                location=[lat, lng],
+                icon=folium.Icon(icon="bicycle", prefix="fa", color=_colors[color]),
+                popup=f"{name}: {bikes}"
+            )
+            marker.add_to(map)
+    elif mode == "cluster":
+        data = [list(row) for row in zip(np.round(points["lat"], 6).tolist(), np.round(points["lng"], 6).tolist(),
+                                         points["color"].tolist(), points["bikes"].tolist(), points["name"])]
+        FastMarkerCluster(data, callback=_cluster_callback).add_to(map)
+    else:
+        layer = folium.GeoJson(
+            os.path.join(folder, data_filename),
+            embed=False,
+            marker=folium.CircleMarker(radius=5, weight=1, fill=True, fill_opacity=0.8),
+            on_each_feature=JsCode(_popup_callback),
         )
-        marker.add_to(map)
+        layer.embed_link = data_filename  # Relative to the html file
+        layer.add_to(map)
     map.save(save_path)
 
 
@@ -48,12 +80,137 @@ def heatmap(obj: Country | Organization | City, radius: int = 20,
     save_path = os.path.join(folder, filename)
 
     # Data and scale params
-    data = [(s.lat, s.lng, s.bikes_available_to_rent) for s in obj.stations.values()]
-    d_lat = max(data, key=lambda x: x[0])[0] - min(data, key=lambda x: x[0])[0]
-    d_lng = max(data, key=lambda x: x[1])[0] - min(data, key=lambda x: x[1])[0]
-    scale = max(d_lat, d_lng)
+    points = _station_points(obj)
+    data = np.stack([points["lat"], points["lng"], points["bikes"]], axis=1).tolist()
 
-    zoom_start = 13 - int(scale)  # approximate scale
-    map = folium.Map(location=[obj.lat, obj.lng], zoom_start=zoom_start)
+    map = folium.Map(location=[obj.lat, obj.lng], zoom_start=_zoom_start(points["lat"], points["lng"]))
     HeatMap(data, radius=radius).add_to(map)
     map.save(save_path)
+
+
+def heatmap_timelapse(snapshots: Iterable[tuple[datetime, Country | Organization | City]],
+                      frame_interval: Optional[timedelta] = None, cell_deg: float = 0.005, radius: int = 20,
+                      folder: Optional[str] = None, filename: Optional[str] = None):
+    '''Create an html time-lapse heatmap of bikes available to rent from (timestamp, snapshot) pairs.
+
+    snapshots are typically streamed from the history, e.g. client.history.city(id, start, end).
+    See heatmap_frames for the binning.'''
+    if folder is None:
+        folder = "heatmaps"
+        os.makedirs(folder, exist_ok=True)
+    timestamps, frames, center = heatmap_frames(snapshots, frame_interval, cell_deg)
+    if not frames:
+        raise ValueError("No snapshots to show.")
+    if filename is None:
+        filename = f"heatmap_timelapse_{timestamps[0]:%Y_%m_%d__%H_%M_%S}.html"
+    save_path = os.path.join(folder, filename)
+
+    # Common color scale for all frames
+    peak = max((w.max() for _, _, w in frames if len(w)), default=0) or 1
+    data = [np.stack([np.round(lat, 5), np.round(lng, 5), np.round(w / peak, 3)], axis=1).tolist()
+            for lat, lng, w in frames]
+    lats = np.concatenate([lat for lat, _, _ in frames])
+    lngs = np.concatenate([lng for _, lng, _ in frames])
+    zoom_start = _zoom_start(lats, lngs) if len(lats) else 13
+    map = folium.Map(location=list(center), zoom_start=zoom_start)
+    HeatMapWithTime(data, index=[f"{t:%Y-%m-%d %H:%M}" for t in timestamps], radius=radius).add_to(map)
+    map.save(save_path)
+
+
+def heatmap_frames(snapshots: Iterable[tuple[datetime, Country | Organization | City]],
+                   frame_interval: Optional[timedelta] = None,
+                   cell_deg: float = 0.005) -> tuple[list[datetime], list[tuple[np.ndarray, np.ndarray, np.ndarray]], tuple[float, float]]:
+    '''Bin snapshots onto a fixed grid of cell_deg x cell_deg degrees.
+
+    Every frame holds the (lat, lng, mean bikes available to rent) of the occupied grid cells, with the
+    cell centers as positions. Without frame_interval every snapshot is a frame, otherwise the
+    snapshots in each interval are averaged into one frame. Snapshots are consumed one at a time and
+    only the binned frames are kept, so memory is bounded by the number of occupied cells per frame.
+    Returns the frame timestamps, the frames and the center of the last snapshot.'''
+    step = frame_interval.total_seconds() if frame_interval is not None else None
+    timestamps, frames = [], []
+    center = (0.0, 0.0)
+    current, parts, count = None, [], 0
+
+    def collapse() -> tuple[np.ndarray, np.ndarray]:
+        cells, weights = np.concatenate([c for c, _ in parts]), np.concatenate([w for _, w in parts])
+        cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+        return cells, np.bincount(inverse.ravel(), weights=weights, minlength=len(cells))
+
+    def close():
+        cells, weights = collapse()
+        frames.append(((cells[:, 0] + 0.5) * cell_deg, (cells[:, 1] + 0.5) * cell_deg, weights / count))
+
+    for timestamp, obj in snapshots:
+        key = timestamp if step is None else timestamp.timestamp() // step
+        if key != current and parts:
+            close()
+            parts, count = [], 0
+        if key != current:
+            current = key
+            timestamps.append(timestamp if step is None else datetime.fromtimestamp(key * step))
+        stations = list(obj.stations.values())
+        n = len(stations)
+        lat = np.fromiter((s.lat for s in stations), dtype=np.float64, count=n)
+        lng = np.fromiter((s.lng for s in stations), dtype=np.float64, count=n)
+        bikes = np.fromiter((s.bikes_available_to_rent for s in stations), dtype=np.float64, count=n)
+        parts.append((np.floor(np.stack([lat, lng], axis=1) / cell_deg).astype(np.int64), bikes))
+        count += 1
+        if len(parts) >= 32:  # Long frame intervals
+            parts = [collapse()]
+        center = (obj.lat, obj.lng)
+    if parts:
+        close()
+    return timestamps, frames, center
+
+
+def _station_points(obj: Country | Organization | City) -> dict:
+    '''Positions, bikes available to rent, color codes and names of all stations in one pass.'''
+    stations = list(obj.stations.values())
+    n = len(stations)
+    if n == 0:
+        raise ValueError(f"{obj.name} has no stations to show.")
+    lat = np.fromiter((s.lat for s in stations), dtype=np.float64, count=n)
+    lng = np.fromiter((s.lng for s in stations), dtype=np.float64, count=n)
+    bikes = np.fromiter((s.bikes_available_to_rent for s in stations), dtype=np.int64, count=n)
+    single = np.fromiter(("bike" in s.name.lower() for s in stations), dtype=bool, count=n)  # Single bikes (not stations)
+    color = np.where(single, 2, np.where(bikes == 0, 1, 0))
+    return {"lat": lat, "lng": lng, "bikes": bikes, "color": color, "name": [s.name for s in stations]}
+
+
+def _zoom_start(lat: np.ndarray, lng: np.ndarray) -> int:
+    scale = max(np.ptp(lat), np.ptp(lng))
+    return 13 - int(scale)  # approximate scale
+
+
+def _write_geojson(points: dict, path: str):
+    '''Write the stations as a GeoJSON feature collection with the marker style in the properties.'''
+    styles = [{"color": c, "fillColor": c} for c in _colors]
+    features = [
+        {"type": "Feature",
+         "geometry": {"type": "Point", "coordinates": [lng, lat]},
+         "properties": {"name": name, "bikes": bikes, "style": styles[color]}}
+        for lat, lng, bikes, color, name in zip(np.round(points["lat"], 6).tolist(), np.round(points["lng"], 6).tolist(),
+                                                points["bikes"].tolist(), points["color"].tolist(), points["name"])
+    ]
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f, separators=(",", ":"))
+    os.replace(tmp, path)  # Maps loading the file never see a partial write
+
+
+_cluster_callback = f"""
+function (row) {{
+    var colors = {json.dumps(_colors)};
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]),
+        {{radius: 6, weight: 1, color: colors[row[2]], fillColor: colors[row[2]], fillOpacity: 0.8}});
+    marker.bindPopup(row[4] + ": " + row[3]);
+    return marker;
+}};
+"""
+
+_popup_callback = """
+function (feature, layer) {
+    layer.bindPopup(feature.properties.name + ": " + feature.properties.bikes);
+}
+"""
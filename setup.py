@@ -16,5 +16,6 @@ setup(
         "Bug Tracker": "https://github.com/sIDsID11/nextbike/Issues"
     },
     license='MIT',
-    install_requires=['requests', 'folium'],
+    install_requires=['requests', 'folium', 'numpy'],
+    python_requires='>=3.10',
 )
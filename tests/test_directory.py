@@ -0,0 +1,54 @@
+import copy
+import json
+
+from benchmarks.fixtures import generate
+from benchmarks.server import FakeServer
+from nextbike import Client
+
+
+def _add_organization(data: dict) -> dict:
+    '''Copy of a feed with another organization in the country of the first one.'''
+    data = copy.deepcopy(data)
+    organization = copy.deepcopy(data["countries"][0])
+    organization["name"] = "nextbike New"
+    organization["domain"] = "new"
+    for city in organization["cities"]:
+        city["uid"] += 100000
+        city["name"] = f"New {city['name']}"
+        for station in city["places"]:
+            station["uid"] += 100000
+    data["countries"].append(organization)
+    return data
+
+
+def test_new_organization_is_picked_up():
+    data = generate(2, 2, 1, 3, 1)
+    country_code = data["countries"][0]["country"].lower()
+    with FakeServer(json.dumps(data).encode()) as server:
+        client = Client(refresh_fetches=3, _url=server.url)
+        assert client.fetch(country_codes=[country_code])  # Whole feed
+        server.update(json.dumps(_add_organization(data)).encode())
+        for _ in range(3):
+            assert client.fetch(country_codes=[country_code])  # By domain
+            assert "nextbike New" not in client.organizations
+        assert client.fetch(country_codes=[country_code])  # Whole feed again
+        assert "nextbike New" in client.organizations
+        assert client.fetch(country_codes=[country_code])  # By domain, including the new one
+        assert "nextbike New" in client.organizations
+
+
+def test_stale_country_is_looked_up_again():
+    data = generate(2, 2, 1, 3, 1)
+    country_code = data["countries"][0]["country"].lower()
+    with FakeServer(json.dumps(data).encode()) as server:
+        client = Client(_url=server.url)
+        assert client.fetch(country_codes=[country_code])
+        # The organizations of the country moved to new domains
+        moved = copy.deepcopy(data)
+        for organization in moved["countries"]:
+            organization["domain"] += "-moved"
+        server.update(json.dumps(moved).encode())
+        assert client.fetch(country_codes=[country_code])  # By the old domains, the country is missing
+        assert not client.organizations
+        assert client.fetch(country_codes=[country_code])  # Whole feed
+        assert len(client.organizations) == 2